@@ -0,0 +1,77 @@
+"""
+Shared MS Graph token helper for the local scripts.
+Tokens are cached on disk so repeated script runs skip the OAuth round-trip.
+"""
+import fcntl
+import json
+import os
+import time
+from pathlib import Path
+
+import httpx
+
+TOKEN_CACHE_PATH = Path.home() / ".cache" / "regent" / "token.json"
+TOKEN_EXPIRY_MARGIN = 120  # seconds of validity required to reuse a cached token
+
+
+def _cache_key() -> str:
+    return f"{os.environ['MS_TENANT_ID']}:{os.environ['MS_CLIENT_ID']}"
+
+
+def _read_cached_token() -> str | None:
+    try:
+        data = json.loads(TOKEN_CACHE_PATH.read_text())
+    except (OSError, ValueError):
+        return None
+    if data.get("key") != _cache_key():
+        return None
+    if time.time() >= data.get("expires_at", 0) - TOKEN_EXPIRY_MARGIN:
+        return None
+    return data.get("access_token")
+
+
+def _write_cached_token(access_token: str, expires_in: int):
+    TOKEN_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    # Created owner-only, so the token is never readable by other users; a file
+    # left by an older version is tightened before anything is written to it
+    fd = os.open(TOKEN_CACHE_PATH, os.O_RDWR | os.O_CREAT, 0o600)
+    os.fchmod(fd, 0o600)
+    with os.fdopen(fd, "r+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.seek(0)
+            f.truncate()
+            json.dump({
+                "key": _cache_key(),
+                "access_token": access_token,
+                "expires_at": time.time() + expires_in,
+            }, f)
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+async def get_access_token(client: httpx.AsyncClient) -> str:
+    """Get OAuth2 access token, reusing the on-disk cache while it is still valid."""
+    cached = _read_cached_token()
+    if cached:
+        return cached
+
+    tenant_id = os.environ["MS_TENANT_ID"]
+    client_id = os.environ["MS_CLIENT_ID"]
+    client_secret = os.environ["MS_CLIENT_SECRET"]
+
+    url = f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token"
+
+    response = await client.post(
+        url,
+        data={
+            "client_id": client_id,
+            "client_secret": client_secret,
+            "scope": "https://graph.microsoft.com/.default",
+            "grant_type": "client_credentials",
+        },
+    )
+    response.raise_for_status()
+    data = response.json()
+    _write_cached_token(data["access_token"], data.get("expires_in", 3600))
+    return data["access_token"]
@@ -0,0 +1,21 @@
+"""
+Shared .env loader for the local scripts.
+"""
+import functools
+import os
+import re
+from pathlib import Path
+
+ENV_PATH = Path(__file__).parent.parent / ".env"
+
+# KEY=value lines; comment and blank lines never match. Trailing \r is
+# trimmed too, for CRLF files read without newline translation
+_ENV_LINE_RE = re.compile(r"^[ \t]*([^#=\s]+)[ \t]*=[ \t]*(.*?)[ \t\r]*$", re.M)
+
+
+@functools.cache
+def load_env():
+    """Load KEY=value pairs from the repo .env into os.environ (once per process)."""
+    if not ENV_PATH.exists():
+        return
+    os.environ.update(dict(_ENV_LINE_RE.findall(ENV_PATH.read_text())))
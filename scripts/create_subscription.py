@@ -5,44 +5,19 @@ Local script to create MS Graph webhook subscription for debugging.
 import asyncio
 import os
 from datetime import datetime, timedelta, timezone
-from pathlib import Path
 
-# Load .env file
-env_path = Path(__file__).parent.parent / ".env"
-if env_path.exists():
-    with open(env_path) as f:
-        for line in f:
-            line = line.strip()
-            if line and not line.startswith("#") and "=" in line:
-                key, value = line.split("=", 1)
-                os.environ[key] = value
+from _env import load_env
+
+load_env()
 
 import httpx
 
+from _auth import get_access_token
 
-async def get_access_token():
-    """Get OAuth2 access token."""
-    tenant_id = os.environ["MS_TENANT_ID"]
-    client_id = os.environ["MS_CLIENT_ID"]
-    client_secret = os.environ["MS_CLIENT_SECRET"]
-    
-    url = f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token"
-    
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        response = await client.post(
-            url,
-            data={
-                "client_id": client_id,
-                "client_secret": client_secret,
-                "scope": "https://graph.microsoft.com/.default",
-                "grant_type": "client_credentials",
-            },
-        )
-        response.raise_for_status()
-        return response.json()["access_token"]
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=20, max_connections=100)
 
 
-async def create_subscription(access_token: str):
+async def create_subscription(client: httpx.AsyncClient, access_token: str):
     """Create webhook subscription."""
     user_email = os.environ["MS_USER_EMAIL"]
     webhook_url = "https://regent-support-email-automation.muhammad-56e.workers.dev/webhook"
@@ -67,39 +42,37 @@ async def create_subscription(access_token: str):
     print(f"  expirationDateTime: {payload['expirationDateTime']}")
     print(f"  clientState: {payload['clientState'][:10]}...")
     
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        response = await client.post(
-            "https://graph.microsoft.com/v1.0/subscriptions",
-            headers={
-                "Authorization": f"Bearer {access_token}",
-                "Content-Type": "application/json",
-            },
-            json=payload,
-        )
-        
-        print(f"\nResponse status: {response.status_code}")
-        print(f"Response body: {response.text}")
-        
-        if response.status_code == 201:
-            data = response.json()
-            print("\n SUCCESS!")
-            print(f"Subscription ID: {data['id']}")
-            print(f"Expires: {data['expirationDateTime']}")
-            return data
-        
-        return None
+    response = await client.post(
+        "https://graph.microsoft.com/v1.0/subscriptions",
+        headers={
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/json",
+        },
+        json=payload,
+    )
+    
+    print(f"\nResponse status: {response.status_code}")
+    print(f"Response body: {response.text}")
+    
+    if response.status_code == 201:
+        data = response.json()
+        print("\n SUCCESS!")
+        print(f"Subscription ID: {data['id']}")
+        print(f"Expires: {data['expirationDateTime']}")
+        return data
+    
+    return None
 
 
-async def list_subscriptions(access_token: str):
+async def list_subscriptions(client: httpx.AsyncClient, access_token: str):
     """List existing subscriptions."""
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        response = await client.get(
-            "https://graph.microsoft.com/v1.0/subscriptions",
-            headers={"Authorization": f"Bearer {access_token}"},
-        )
-        if response.status_code == 200:
-            return response.json().get("value", [])
-        return []
+    response = await client.get(
+        "https://graph.microsoft.com/v1.0/subscriptions",
+        headers={"Authorization": f"Bearer {access_token}"},
+    )
+    if response.status_code == 200:
+        return response.json().get("value", [])
+    return []
 
 
 async def main():
@@ -107,32 +80,34 @@ async def main():
     print("MS Graph Subscription Creator (Debug)")
     print("=" * 60)
     
-    print("\n[1] Getting access token...")
-    token = await get_access_token()
-    print("    OK")
+    # One client for the whole run so sequential requests reuse connections
+    async with httpx.AsyncClient(timeout=60.0, limits=HTTP_LIMITS) as client:
+        print("\n[1] Getting access token...")
+        token = await get_access_token(client)
+        print("    OK")
     
-    print("\n[2] Checking for existing subscriptions...")
-    existing = await list_subscriptions(token)
-    user_email = os.environ["MS_USER_EMAIL"]
+        print("\n[2] Checking for existing subscriptions...")
+        existing = await list_subscriptions(client, token)
+        user_email = os.environ["MS_USER_EMAIL"]
     
-    for sub in existing:
-        if user_email in sub.get("resource", ""):
-            print(f"    Found existing subscription: {sub['id']}")
-            print(f"    Resource: {sub['resource']}")
-            print(f"    Expires: {sub['expirationDateTime']}")
-            print("\n    Subscription already exists. Delete it first if you want to recreate.")
-            return
+        for sub in existing:
+            if user_email in sub.get("resource", ""):
+                print(f"    Found existing subscription: {sub['id']}")
+                print(f"    Resource: {sub['resource']}")
+                print(f"    Expires: {sub['expirationDateTime']}")
+                print("\n    Subscription already exists. Delete it first if you want to recreate.")
+                return
     
-    print("    No existing subscription found.")
+        print("    No existing subscription found.")
     
-    print("\n[3] Creating subscription...")
-    result = await create_subscription(token)
+        print("\n[3] Creating subscription...")
+        result = await create_subscription(client, token)
     
-    if result:
-        print("\n" + "=" * 60)
-        print("SAVE THIS SUBSCRIPTION ID:")
-        print(result['id'])
-        print("=" * 60)
+        if result:
+            print("\n" + "=" * 60)
+            print("SAVE THIS SUBSCRIPTION ID:")
+            print(result['id'])
+            print("=" * 60)
 
 
 if __name__ == "__main__":
@@ -14,15 +14,9 @@ sys.path.append(str(ROOT_DIR / "src"))
 
 from config import GEMINI_API_URL  # noqa: E402
 
-# Load .env file
-env_path = ROOT_DIR / ".env"
-if env_path.exists():
-    with open(env_path) as f:
-        for line in f:
-            line = line.strip()
-            if line and not line.startswith("#") and "=" in line:
-                key, value = line.split("=", 1)
-                os.environ[key] = value
+from _env import load_env  # noqa: E402
+
+load_env()
 
 
 async def test_gemini():
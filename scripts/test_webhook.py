@@ -4,64 +4,48 @@ Test script to simulate MS Graph webhook notification.
 """
 import asyncio
 import os
-from pathlib import Path
-
-# Load .env file
-env_path = Path(__file__).parent.parent / ".env"
-if env_path.exists():
-    with open(env_path) as f:
-        for line in f:
-            line = line.strip()
-            if line and not line.startswith("#") and "=" in line:
-                key, value = line.split("=", 1)
-                os.environ[key] = value
+
+from _env import load_env
+
+load_env()
 
 import httpx
 
+from _auth import get_access_token
 
-async def get_access_token():
-    """Get OAuth2 access token."""
-    tenant_id = os.environ["MS_TENANT_ID"]
-    client_id = os.environ["MS_CLIENT_ID"]
-    client_secret = os.environ["MS_CLIENT_SECRET"]
-    
-    url = f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token"
-    
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            url,
-            data={
-                "client_id": client_id,
-                "client_secret": client_secret,
-                "scope": "https://graph.microsoft.com/.default",
-                "grant_type": "client_credentials",
-            },
-        )
-        response.raise_for_status()
-        return response.json()["access_token"]
-
-
-async def get_latest_email(access_token: str):
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=20, max_connections=100)
+
+WORKER_URL = "https://regent-support-email-automation.muhammad-56e.workers.dev"
+
+# The worker answers 202 and processes in the background; poll /emails until
+# the message shows up
+POLL_TIMEOUT = 60.0
+POLL_INTERVAL = 2.0
+
+
+async def get_latest_email(client: httpx.AsyncClient, access_token: str):
     """Get the most recent email from inbox."""
     user_email = os.environ["MS_USER_EMAIL"]
     url = f"https://graph.microsoft.com/v1.0/users/{user_email}/mailFolders/inbox/messages"
     
-    async with httpx.AsyncClient() as client:
-        response = await client.get(
-            url,
-            headers={"Authorization": f"Bearer {access_token}"},
-            params={"$top": 1, "$orderby": "receivedDateTime desc"},
-        )
-        response.raise_for_status()
-        data = response.json()
-        if data.get("value"):
-            return data["value"][0]
-        return None
-
-
-async def simulate_webhook(message_id: str):
+    response = await client.get(
+        url,
+        headers={
+            "Authorization": f"Bearer {access_token}",
+            "Accept": "application/json;odata.metadata=none",
+        },
+        params={"$top": 1, "$orderby": "receivedDateTime desc", "$select": "id,subject"},
+    )
+    response.raise_for_status()
+    data = response.json()
+    if data.get("value"):
+        return data["value"][0]
+    return None
+
+
+async def simulate_webhook(client: httpx.AsyncClient, message_id: str):
     """Send a simulated webhook notification to our worker."""
-    worker_url = "https://regent-support-email-automation.muhammad-56e.workers.dev/webhook"
+    worker_url = f"{WORKER_URL}/webhook"
     client_state = os.environ["WEBHOOK_VALIDATION_TOKEN"]
     user_email = os.environ["MS_USER_EMAIL"]
     
@@ -87,16 +71,29 @@ async def simulate_webhook(message_id: str):
     print(f"Message ID: {message_id}")
     print(f"Resource: {notification['value'][0]['resource']}")
     
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            worker_url,
-            json=notification,
-            headers={"Content-Type": "application/json"}
-        )
-        
-        print(f"\nResponse status: {response.status_code}")
-        print(f"Response body: {response.text}")
-        return response.status_code == 202
+    response = await client.post(
+        worker_url,
+        json=notification,
+        headers={"Content-Type": "application/json"}
+    )
+    
+    print(f"\nResponse status: {response.status_code}")
+    print(f"Response body: {response.text}")
+    return response.status_code == 202
+
+
+async def wait_for_processed(client: httpx.AsyncClient, message_id: str):
+    """Poll /emails until message_id appears; returns the email list, or None on timeout."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + POLL_TIMEOUT
+    while True:
+        response = await client.get(f"{WORKER_URL}/emails")
+        emails = response.json().get("emails", [])
+        if any(e.get("message_id") == message_id for e in emails):
+            return emails
+        if loop.time() + POLL_INTERVAL > deadline:
+            return None
+        await asyncio.sleep(POLL_INTERVAL)
 
 
 async def main():
@@ -104,36 +101,35 @@ async def main():
     print("Webhook Notification Test")
     print("=" * 60)
     
-    print("\n[1] Getting access token...")
-    token = await get_access_token()
-    print("    OK")
+    # One client for the whole run so sequential requests reuse connections
+    async with httpx.AsyncClient(timeout=60.0, limits=HTTP_LIMITS) as client:
+        print("\n[1] Getting access token...")
+        token = await get_access_token(client)
+        print("    OK")
     
-    print("\n[2] Getting latest email from inbox...")
-    email = await get_latest_email(token)
-    if not email:
-        print("    No emails found!")
-        return
+        print("\n[2] Getting latest email from inbox...")
+        email = await get_latest_email(client, token)
+        if not email:
+            print("    No emails found!")
+            return
     
-    print(f"    Found: {email.get('subject', '(no subject)')[:50]}")
-    print(f"    ID: {email['id']}")
+        print(f"    Found: {email.get('subject', '(no subject)')[:50]}")
+        print(f"    ID: {email['id']}")
     
-    print("\n[3] Simulating webhook notification...")
-    success = await simulate_webhook(email["id"])
+        print("\n[3] Simulating webhook notification...")
+        success = await simulate_webhook(client, email["id"])
     
-    if success:
-        print("\n[4] Checking if email was processed...")
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                "https://regent-support-email-automation.muhammad-56e.workers.dev/emails"
-            )
-            data = response.json()
-            emails = data.get("emails", [])
-            print(f"    Processed emails in D1: {len(emails)}")
-            if emails:
+        if success:
+            print(f"\n[4] Waiting up to {POLL_TIMEOUT:.0f}s for the email to be processed...")
+            emails = await wait_for_processed(client, email["id"])
+            if emails is None:
+                print("    Timed out - email not in D1 yet (check the worker logs)")
+            else:
+                print(f"    Processed emails in D1: {len(emails)}")
                 for e in emails[:3]:
                     print(f"    - {e.get('subject', '(no subject)')[:40]}: {e.get('classification')}")
     
-    print("\n" + "=" * 60)
+        print("\n" + "=" * 60)
 
 
 if __name__ == "__main__":
@@ -1,155 +1,413 @@
 """
 Gemini-based email classifier.
 """
+import asyncio
+import hashlib
 import json
-from js import fetch, Object, console, JSON
+import os
+import random
+import re
+from js import fetch, Object, console, AbortSignal, Uint8Array
 from pyodide.ffi import to_js as _to_js
 
-from config import get_classification_prompt, CLASSIFICATION_TAGS, GEMINI_API_URL
+from config import (
+    get_classification_prompt,
+    CLASSIFICATION_TAGS,
+    CLASSIFICATION_RULES,
+    GEMINI_API_URL,
+)
 from utils import strip_html
 
+# Verbose per-request diagnostics (body sizes, raw responses, token usage)
+_DEBUG = os.environ.get("CLASSIFIER_DEBUG") == "1"
+
+# Raw HTML kept before stripping; the prompt only uses the first 5k chars of text
+MAX_RAW_BODY_CHARS = 25000
+
+# Gemini request retries: attempts, per-attempt deadline, backoff base/cap (seconds)
+GEMINI_MAX_ATTEMPTS = 3
+GEMINI_TIMEOUT_MS = 10000
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 8.0
+RETRYABLE_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+# Max concurrent Gemini requests per isolate. A burst of webhooks queues here
+# instead of tripping the per-project rate limit (free tier ~15 RPM -> 2, paid -> 10).
+GEMINI_MAX_CONCURRENCY = 5
+
+# Body chars checked by the keyword rules
+RULE_BODY_CHARS = 2000
+
+# Classification results remembered per isolate, keyed by content hash
+RESULT_CACHE_SIZE = 512
+
+# Batched requests: emails per Gemini call, body chars per email, output budget per email
+BATCH_MAX_ITEMS = 25
+BATCH_BODY_CHARS = 3000
+BATCH_OUTPUT_TOKENS_PER_ITEM = 128
+
+_GEMINI_SEMAPHORE = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+
+_RESULT_CACHE: dict[bytes, dict] = {}
+
+_VALID_TAGS = frozenset(tag.name for tag in CLASSIFICATION_TAGS)
+
+# Outermost JSON object / array in a model response
+_JSON_OBJECT_RE = re.compile(r"\{.*\}", re.S)
+_JSON_ARRAY_RE = re.compile(r"\[.*\]", re.S)
+
+_RULES = [
+    (re.compile(pattern, re.I), tag, confidence)
+    for pattern, tag, confidence in CLASSIFICATION_RULES
+]
+
+# Start of the quoted thread history in a stripped body (Outlook separator or
+# header block, "Original Message" marker, or a Gmail-style attribution line)
+_QUOTE_HEADER_RE = re.compile(
+    r"_{10,}|-{3,}\s*Original Message|\bFrom:\s.{1,200}?\bSent:\s|\bOn\s.{1,200}?\bwrote:",
+    re.I | re.S,
+)
+# Reply/forward subjects carry the thread's first subject along
+_REPLY_SUBJECT_RE = re.compile(r"^\s*(?:re|fwd?|aw|sv)\s*:", re.I)
+
+# Everything in the prompt before the subject is static
+_PROMPT_PREFIX = (
+    get_classification_prompt()
+    + "\n\n---\n\nPlease classify the following email:\n\nSUBJECT: "
+)
+
+_BATCH_PROMPT_PREFIX = get_classification_prompt() + "\n\n---\n\n"
+
 
 def to_js(obj):
     return _to_js(obj, dict_converter=Object.fromEntries)
 
 
-def js_to_py(js_obj):
-    """Convert JS object to Python dict via JSON serialization."""
-    return json.loads(JSON.stringify(js_obj))
+# Static request headers, converted to JS once per isolate
+_GEMINI_HEADERS = to_js({"Content-Type": "application/json"})
 
 
-async def classify_email(api_key: str, subject: str, body: str) -> dict:
+def _match_rule(subject: str, clean_body: str) -> dict | None:
     """
-    Classify an email using Gemini 2.5 Flash Lite.
-    Returns: {
-        "classification": str,
-        "confidence": float,
-        "reason": str,
-        "token_usage": {"input_tokens": int, "output_tokens": int, "total_tokens": int} | None
-    }
+    Classify without Gemini when a keyword rule matches the most recent message.
+    Quoted history and a reply/forward subject are ignored, so an earlier
+    message in the thread can't decide how a new one is classified.
     """
-    system_prompt = get_classification_prompt()
+    head = clean_body[:RULE_BODY_CHARS]
+    quote = _QUOTE_HEADER_RE.search(head)
+    if quote:
+        head = head[:quote.start()]
+    if _REPLY_SUBJECT_RE.match(subject):
+        subject = ""
+    for pattern, tag, confidence in _RULES:
+        match = pattern.search(subject) or pattern.search(head)
+        if match:
+            return {
+                "classification": tag,
+                "confidence": confidence,
+                "reason": f"Keyword rule matched: '{match.group(0)}'",
+                "token_usage": None,
+            }
+    return None
 
-    # Strip HTML from body (MS Graph returns HTML content)
-    clean_body = strip_html(body)
 
-    # Log body lengths for debugging
-    console.log(
-        f"[Classification] Raw body length: {len(body)}, Clean body length: {len(clean_body)}, Truncated to: {min(len(clean_body), 5000)}")
+def _cache_key(subject: str, clean_body: str) -> bytes:
+    data = subject.encode() + b"\0" + clean_body[:5000].encode()
+    return hashlib.blake2b(data, digest_size=16).digest()
+
 
-    user_prompt = f"""Please classify the following email:
+def _cache_get(key: bytes) -> dict | None:
+    """Return a cached classification; tokens were already billed, so usage is None."""
+    hit = _RESULT_CACHE.get(key)
+    return dict(hit) if hit else None
 
-SUBJECT: {subject}
 
-BODY:
-{clean_body[:5000]}"""  # Truncate body to ~5k chars to avoid token limits
+def _cache_put(key: bytes, result: dict):
+    """Remember a successful classification, evicting the oldest entry when full."""
+    if result["confidence"] <= 0.0:
+        return
+    _RESULT_CACHE[key] = {**result, "token_usage": None}
+    if len(_RESULT_CACHE) > RESULT_CACHE_SIZE:
+        del _RESULT_CACHE[next(iter(_RESULT_CACHE))]
 
-    payload = {
+
+def _build_payload(prompt_text: str, max_output_tokens: int) -> dict:
+    return {
         "contents": [
             {
                 "role": "user",
-                "parts": [{"text": f"{system_prompt}\n\n---\n\n{user_prompt}"}]
+                "parts": [{"text": prompt_text}]
             }
         ],
         "generationConfig": {
             "temperature": 0.1,  # Low temperature for consistent classification
-            "maxOutputTokens": 512,
+            "maxOutputTokens": max_output_tokens,
             "responseMimeType": "application/json",
         }
     }
 
+
+def _retry_delay(attempt: int, retry_after: str | None) -> float:
+    """Exponential backoff with full jitter, honoring a Retry-After header in seconds."""
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+    if retry_after:
+        try:
+            delay = max(delay, min(RETRY_MAX_DELAY, float(retry_after)))
+        except ValueError:
+            pass
+    return delay
+
+
+async def _post_gemini(api_key: str, payload: dict):
+    """
+    POST to Gemini, retrying timeouts, network errors, 429 and 5xx responses.
+    Returns the last response; raises only if every attempt failed to get one.
+    """
     url = f"{GEMINI_API_URL}?key={api_key}"
+    # Send UTF-8 bytes so fetch needn't re-encode a JS string
+    body_bytes = json.dumps(payload).encode()
+    body = Uint8Array.new(len(body_bytes))
+    body.assign(body_bytes)
 
-    response = await fetch(
-        url,
-        to_js({
-            "method": "POST",
-            "headers": {
-                "Content-Type": "application/json",
-            },
-            "body": json.dumps(payload),
-        })
-    )
+    for attempt in range(GEMINI_MAX_ATTEMPTS):
+        last_attempt = attempt == GEMINI_MAX_ATTEMPTS - 1
+        try:
+            async with _GEMINI_SEMAPHORE:
+                response = await fetch(
+                    url,
+                    to_js({
+                        "method": "POST",
+                        "headers": _GEMINI_HEADERS,
+                        "body": body,
+                        "signal": AbortSignal.timeout(GEMINI_TIMEOUT_MS),
+                    })
+                )
+        except Exception as e:
+            if last_attempt:
+                raise
+            console.warn(f"Gemini request failed (attempt {attempt + 1}): {e}")
+            await asyncio.sleep(_retry_delay(attempt, None))
+            continue
 
-    if not response.ok:
-        error_text = await response.text()
-        console.error(f"Gemini API error: {response.status} - {error_text}")
-        return {
-            "classification": "general",
-            "confidence": 0.0,
-            "reason": f"Classification failed: {response.status}",
-            "token_usage": None,
-        }
+        if response.status not in RETRYABLE_STATUSES or last_attempt:
+            return response
+
+        console.warn(f"Gemini returned {response.status} (attempt {attempt + 1}), retrying")
+        await asyncio.sleep(_retry_delay(attempt, response.headers.get("Retry-After")))
 
-    js_data = await response.json()
-    data = js_to_py(js_data)
 
-    # Extract token usage from response
+def _extract_token_usage(data: dict) -> dict | None:
+    """Extract token usage from a Gemini response."""
     usage_metadata = data.get("usageMetadata", {})
-    token_usage = None
-    if usage_metadata:
-        token_usage = {
-            "input_tokens": usage_metadata.get("promptTokenCount", 0),
-            "output_tokens": usage_metadata.get("candidatesTokenCount", 0),
-            "total_tokens": usage_metadata.get("totalTokenCount", 0),
-        }
+    if not usage_metadata:
+        return None
+    token_usage = {
+        "input_tokens": usage_metadata.get("promptTokenCount", 0),
+        "output_tokens": usage_metadata.get("candidatesTokenCount", 0),
+        "total_tokens": usage_metadata.get("totalTokenCount", 0),
+    }
+    if _DEBUG:
         console.log(
             f"[Gemini] Token usage - Input: {token_usage['input_tokens']}, Output: {token_usage['output_tokens']}, Total: {token_usage['total_tokens']}")
+    return token_usage
 
-    try:
-        # Extract the text response safely
-        candidates = data.get("candidates", [])
-        if not candidates:
-            raise ValueError("No candidates in response")
 
-        content = candidates[0].get("content", {})
-        parts = content.get("parts", [])
-        if not parts:
-            raise ValueError("No parts in response")
+def _extract_text(data: dict) -> str:
+    """Extract the text response safely, raising ValueError if it is missing."""
+    candidates = data.get("candidates", [])
+    if not candidates:
+        raise ValueError("No candidates in response")
 
-        text_response = parts[0].get("text", "")
+    content = candidates[0].get("content", {})
+    parts = content.get("parts", [])
+    if not parts:
+        raise ValueError("No parts in response")
+
+    text_response = parts[0].get("text", "")
+    if _DEBUG:
         console.log(f"Gemini raw response: {text_response[:300]}...")
+    return text_response
+
+
+def _extract_json(text_response: str, pattern: re.Pattern = _JSON_OBJECT_RE) -> str:
+    """Locate the JSON payload, skipping any markdown fences or surrounding prose."""
+    match = pattern.search(text_response)
+    if not match:
+        raise ValueError("No JSON found in response")
+    if _DEBUG:
+        console.log(f"Parsing JSON: {match.group(0)[:150]}...")
+    return match.group(0)
+
+
+def _validate_result(result: dict, token_usage: dict | None) -> dict:
+    """Validate a parsed classification and build the return dict."""
+    tag = result.get("classification")
+    confidence = float(result.get("confidence", 0.5))
+    if tag in _VALID_TAGS:
+        reason = result.get("reason", "No reason provided")
+    else:
+        tag, confidence = "general", max(0.3, confidence * 0.5)
+        reason = f"Invalid tag corrected to general. Original: {result.get('reason', 'N/A')}"
+    return {
+        "classification": tag,
+        "confidence": confidence,
+        "reason": reason,
+        "token_usage": token_usage,
+    }
+
+
+def _split_token_usage(token_usage: dict | None, count: int) -> list:
+    """
+    Share a batch's token usage across its emails, one fresh dict each.
+    The remainder goes to the first emails, so the shares add up to the total.
+    """
+    if not token_usage:
+        return [None] * count
+    return [
+        {key: value // count + (1 if i < value % count else 0) for key, value in token_usage.items()}
+        for i in range(count)
+    ]
 
-        # With responseMimeType: "application/json", response should be clean JSON
-        # But keep fallback parsing for robustness
-        text_response = text_response.strip()
-
-        # Clean up potential markdown code blocks (fallback)
-        if text_response.startswith("```"):
-            lines = text_response.split("\n")
-            text_response = "\n".join(
-                lines[1:-1] if lines[-1].strip() == "```" else lines[1:])
-
-        # Try to find JSON in the response if needed
-        if not text_response.startswith("{"):
-            start = text_response.find("{")
-            end = text_response.rfind("}") + 1
-            if start != -1 and end > start:
-                text_response = text_response[start:end]
-
-        console.log(f"Parsing JSON: {text_response[:150]}...")
-        result = json.loads(text_response)
-
-        # Validate the classification
-        valid_tags = [tag["name"] for tag in CLASSIFICATION_TAGS]
-        if result.get("classification") not in valid_tags:
-            result["classification"] = "general"
-            result["confidence"] = max(
-                0.3, result.get("confidence", 0.5) * 0.5)
-            result["reason"] = f"Invalid tag corrected to general. Original: {result.get('reason', 'N/A')}"
-
-        return {
-            "classification": result.get("classification", "general"),
-            "confidence": float(result.get("confidence", 0.5)),
-            "reason": result.get("reason", "No reason provided"),
-            "token_usage": token_usage,
-        }
+
+async def classify_email(api_key: str, subject: str, body: str) -> dict:
+    """
+    Classify an email using Gemini 2.5 Flash Lite.
+    Returns: {
+        "classification": str,
+        "confidence": float,
+        "reason": str,
+        "token_usage": {"input_tokens": int, "output_tokens": int, "total_tokens": int} | None
+    }
+    """
+    subject = subject or ""
+    # Strip HTML from body (MS Graph returns HTML content)
+    clean_body = strip_html(body[:MAX_RAW_BODY_CHARS])
+
+    # Log body lengths for debugging
+    if _DEBUG:
+        console.log(
+            f"[Classification] Raw body length: {len(body)}, Clean body length: {len(clean_body)}, Truncated to: {min(len(clean_body), 5000)}")
+
+    rule_result = _match_rule(subject, clean_body)
+    if rule_result:
+        console.log(f"[Classification] {rule_result['reason']} -> {rule_result['classification']}")
+        return rule_result
+
+    # Duplicate emails (auto-replies, mailing lists) skip Gemini entirely
+    cache_key = _cache_key(subject, clean_body)
+    cached = _cache_get(cache_key)
+    if cached:
+        console.log(f"[Classification] Cache hit -> {cached['classification']}")
+        return cached
+
+    result = await _classify_clean(api_key, subject, clean_body)
+    _cache_put(cache_key, result)
+    return result
+
+
+def _failed_result(reason: str, token_usage: dict | None = None) -> dict:
+    return {
+        "classification": "general",
+        "confidence": 0.0,
+        "reason": reason,
+        "token_usage": token_usage,
+    }
+
+
+async def _classify_clean(api_key: str, subject: str, clean_body: str) -> dict:
+    """Classify one already-stripped email with its own Gemini request."""
+    # Truncate body to ~5k chars to avoid token limits
+    prompt_text = _PROMPT_PREFIX + subject + "\n\nBODY:\n" + clean_body[:5000]
+
+    response = await _post_gemini(api_key, _build_payload(prompt_text, 512))
+
+    if not response.ok:
+        error_text = await response.text()
+        console.error(f"Gemini API error: {response.status} - {error_text}")
+        return _failed_result(f"Classification failed: {response.status}")
+
+    # Parse the body text directly rather than converting a JS object graph
+    data = json.loads(await response.text())
+
+    token_usage = _extract_token_usage(data)
+
+    try:
+        text_response = _extract_json(_extract_text(data))
+        return _validate_result(json.loads(text_response), token_usage)
 
     except (json.JSONDecodeError, KeyError, IndexError, TypeError, ValueError) as e:
         console.error(f"Failed to parse Gemini response: {e}")
-        return {
-            "classification": "general",
-            "confidence": 0.0,
-            "token_usage": token_usage,
-            "reason": f"Failed to parse response: {str(e)}",
-        }
+        return _failed_result(f"Failed to parse response: {str(e)}", token_usage)
+
+
+async def classify_emails_batch(api_key: str, items: list) -> list:
+    """
+    Classify several emails with one Gemini request per BATCH_MAX_ITEMS emails.
+    items: [{"subject": str, "body": str}, ...]
+    Returns one classify_email-style dict per item, in the same order.
+    Falls back to per-email classification if a batch response can't be parsed;
+    if the batch request itself fails, its emails get failed results.
+    """
+    results = [None] * len(items)
+    cache_keys = [None] * len(items)
+    pending = []
+    for i, item in enumerate(items):
+        subject = item["subject"] or ""
+        clean_body = strip_html((item["body"] or "")[:MAX_RAW_BODY_CHARS])
+        cache_keys[i] = _cache_key(subject, clean_body)
+        results[i] = _match_rule(subject, clean_body) or _cache_get(cache_keys[i])
+        if results[i] is None:
+            pending.append((i, subject, clean_body))
+
+    for start in range(0, len(pending), BATCH_MAX_ITEMS):
+        chunk = pending[start:start + BATCH_MAX_ITEMS]
+        chunk_results = await _classify_chunk(api_key, [(subject, clean_body) for _, subject, clean_body in chunk])
+        for (i, _, _), result in zip(chunk, chunk_results):
+            results[i] = result
+            _cache_put(cache_keys[i], result)
+    return results
+
+
+async def _classify_chunk(api_key: str, emails: list) -> list:
+    """Classify (subject, clean_body) pairs with one Gemini request."""
+    if len(emails) == 1:
+        return [await _classify_clean(api_key, *emails[0])]
+
+    sections = [
+        f"[{i}] SUBJECT: {subject}\n\nBODY:\n{clean_body[:BATCH_BODY_CHARS]}"
+        for i, (subject, clean_body) in enumerate(emails)
+    ]
+
+    prompt_text = (
+        _BATCH_PROMPT_PREFIX
+        + f"Classify each of the {len(emails)} emails below independently. "
+        + "Return a JSON array with one object per email, in the same order, "
+        + "each in the JSON format above.\n\n"
+        + "\n\n---\n\n".join(sections)
+    )
+    payload = _build_payload(prompt_text, BATCH_OUTPUT_TOKENS_PER_ITEM * len(emails))
+
+    response = await _post_gemini(api_key, payload)
+
+    if not response.ok:
+        # _post_gemini has already retried; per-email requests would only add
+        # load to a rate-limited endpoint and outlast the background task
+        error_text = await response.text()
+        console.error(f"Gemini API error (batch of {len(emails)}): {response.status} - {error_text}")
+        return [_failed_result(f"Classification failed: {response.status}") for _ in emails]
+
+    # Parse the body text directly rather than converting a JS object graph
+    data = json.loads(await response.text())
+
+    token_usages = _split_token_usage(_extract_token_usage(data), len(emails))
+
+    try:
+        text_response = _extract_json(_extract_text(data), _JSON_ARRAY_RE)
+        parsed = json.loads(text_response)
+        if not isinstance(parsed, list) or len(parsed) != len(emails):
+            raise ValueError(f"Expected {len(emails)} results, got {len(parsed) if isinstance(parsed, list) else 'non-list'}")
+        return [_validate_result(result, usage) for result, usage in zip(parsed, token_usages)]
+
+    except (json.JSONDecodeError, KeyError, IndexError, TypeError, ValueError, AttributeError) as e:
+        console.error(f"Failed to parse batched Gemini response, classifying individually: {e}")
+        return [await _classify_clean(api_key, subject, clean_body) for subject, clean_body in emails]
@@ -1,114 +1,132 @@
 """
 Classification configuration - edit tags and examples here.
 """
+import functools
+from dataclasses import dataclass, field
+from typing import Final
 
-CLASSIFICATION_TAGS = [
-    {
-        "name": "academic-results",
-        "description": "Queries regarding the release of marks, viewing results on the portal, or missing marks.",
-        "examples": [
+
+@dataclass(frozen=True, slots=True)
+class Tag:
+    """A classification tag; the prompt header and example bullets are rendered once."""
+    name: str
+    description: str
+    examples: tuple[str, ...]
+    header: str = field(init=False, repr=False)
+    examples_block: str = field(init=False, repr=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, "header", f"**{self.name.upper()}** examples:")
+        object.__setattr__(self, "examples_block", "\n".join(f'  - "{ex}"' for ex in self.examples))
+
+
+CLASSIFICATION_TAGS = (
+    Tag(
+        name="academic-results",
+        description="Queries regarding the release of marks, viewing results on the portal, or missing marks.",
+        examples=(
             "When will the results for Financial Management be released?",
             "I can't view my results on the portal, are they out yet?",
             "My results are blocked but I have paid my fees.",
             "I am missing one exam result from my statement.",
             "I have not received my assignment results yet.",
             "When will the marks be visible on the portal?"
-        ]
-    },
-    {
-        "name": "academic-exam",
-        "description": "Queries regarding final exams, supplementaries, Aegrotat (sick/missed exams), and exam interface formatting issues.",
-        "examples": [
+        ),
+    ),
+    Tag(
+        name="academic-exam",
+        description="Queries regarding final exams, supplementaries, Aegrotat (sick/missed exams), and exam interface formatting issues.",
+        examples=(
             "I missed my exam because I was in hospital, how do I apply for Aegrotat?",
             "I need to apply for the supplementary exam in January",
             "The exam interface didn't allow me to create tables",
             "I lost time due to network issues, will I be penalized?",
             "I submitted the wrong file for my exam"
-        ]
-    },
-    {
-        "name": "academic-assignment",
-        "description": "Queries regarding coursework, assignment submission errors, extension requests, and marking disputes/feedback.",
-        "examples": [
+        ),
+    ),
+    Tag(
+        name="academic-assignment",
+        description="Queries regarding coursework, assignment submission errors, extension requests, and marking disputes/feedback.",
+        examples=(
             "I submitted the wrong file for my WDA Economics assignment",
             "Why did the whole class get 35/70 with no feedback?",
             "My assignment marks are not showing on the portal",
             "Can I request a remark for my assignment?",
             "I missed the quiz deadline due to illness"
-        ]
-    },
-    {
-        "name": "admin-transcript",
-        "description": "Requests for official/unofficial transcripts, academic records, and resolving transcript holds.",
-        "examples": [
+        ),
+    ),
+    Tag(
+        name="admin-transcript",
+        description="Requests for official/unofficial transcripts, academic records, and resolving transcript holds.",
+        examples=(
             "I have a transcript hold but my account is paid in full.",
             "Please send me my official transcript for a job application.",
             "I need to download my unofficial transcript but it says unavailable.",
             "Can I get a full year transcript sent to my employer?",
             "I need a letter of completion and my academic record.",
             "Why is there a hold on my transcript?"
-        ]
-    },
-    {
-        "name": "admin-graduation",
-        "description": " inquiries about graduation ceremonies, dates, and collection of certificates.",
-        "examples": [
+        ),
+    ),
+    Tag(
+        name="admin-graduation",
+        description=" inquiries about graduation ceremonies, dates, and collection of certificates.",
+        examples=(
             "When will the graduation details be shared?",
             "When and how can I collect my official degree certificate?",
             "Is the graduation ceremony taking place in Johannesburg?",
             "I have completed my degree, what are the next steps for graduation?",
             "Will I receive a digital certificate?"
-        ]
-    },
-    {
-        "name": "finance-payment",
-        "description": "Issues related to payments made, proof of payment (POP) submission, refunds, and unblocking accounts.",
-        "examples": [
+        ),
+    ),
+    Tag(
+        name="finance-payment",
+        description="Issues related to payments made, proof of payment (POP) submission, refunds, and unblocking accounts.",
+        examples=(
             "Please find attached my proof of payment.",
             "I have paid my fees but my results are still blocked.",
             "I am on a bursary, why is my account showing arrears?",
             "I would like to request a refund for overpayment.",
             "Please allocate this payment to my student number.",
             "My employer has paid the fees, please update my account."
-        ]
-    },
-    {
-        "name": "finance-fees",
-        "description": "Requests for invoices, fee statements, quotes, and balance inquiries.",
-        "examples": [
+        ),
+    ),
+    Tag(
+        name="finance-fees",
+        description="Requests for invoices, fee statements, quotes, and balance inquiries.",
+        examples=(
             "How much do I currently owe on my account?",
             "Please send me a fee statement for the current year.",
             "I need a quote for my 3rd-year fees to send to my sponsor.",
             "Can I get a pro forma invoice for next year?",
             "Please advise on the fee amount to bring my account up to date."
-        ]
-    },
-    {
-        "name": "registration",
-        "description": "Enrolling for new academic years, adding/repeating modules, and registration forms.",
-        "examples": [
+        ),
+    ),
+    Tag(
+        name="registration",
+        description="Enrolling for new academic years, adding/repeating modules, and registration forms.",
+        examples=(
             "How do I register for the 2026 academic year?",
             "I need to re-register for a module I failed.",
             "Can you send me the registration form for the next semester?",
             "I want to register for a single module.",
             "What is the deadline to register for the second semester?"
-        ]
-    },
-    {
-        "name": "technical-proctoring",
-        "description": "Urgent issues specifically related to SMOWL, camera failures, 'Error C-LS-1001', or being kicked out/freezing *during* an active exam.",
-        "examples": [
+        ),
+    ),
+    Tag(
+        name="technical-proctoring",
+        description="Urgent issues specifically related to SMOWL, camera failures, 'Error C-LS-1001', or being kicked out/freezing *during* an active exam.",
+        examples=(
             "My SMOWL says 'something went wrong contact administrator'",
             "Error C-LS-1001",
             "I was writing my exam and the screen disappeared",
             "My camera went off in the middle of the exam",
             "It says I am unregistered but I registered yesterday"
-        ]
-    },
-    {
-        "name": "technical-access",
-        "description": "General login issues, password resets, and portal access problems NOT occurring during an active exam.",
-        "examples": [
+        ),
+    ),
+    Tag(
+        name="technical-access",
+        description="General login issues, password resets, and portal access problems NOT occurring during an active exam.",
+        examples=(
             "I cannot log into the student portal",
             "I cannot log into the myRegent app",
             "I cannot log into the myRegent website",
@@ -116,48 +134,67 @@ CLASSIFICATION_TAGS = [
             "My profile is blocked",
             "I can't access the LMS to view my modules",
             "Do I need to register for Smowl again?"
-        ]
-    },
-    {
-        "name": "general-inquiry",
-        "description": "Low-urgency information requests: Timetables, module codes, calendar dates, contact info.",
-        "examples": [
+        ),
+    ),
+    Tag(
+        name="general-inquiry",
+        description="Low-urgency information requests: Timetables, module codes, calendar dates, contact info.",
+        examples=(
             "Please provide module codes for Business Stats for my bursary",
             "Where can I find the exam timetable?",
             "What is the pass mark for this module?",
             "How do I calculate if I qualify for the exam?",
-        ]
-    },
-    {
-        "name": "complaint-escalation",
-        "description": "Formal grievances, group complaints about lecturers/marking, or repeated service failures requiring management view.",
-        "examples": [
+        ),
+    ),
+    Tag(
+        name="complaint-escalation",
+        description="Formal grievances, group complaints about lecturers/marking, or repeated service failures requiring management view.",
+        examples=(
             "I am writing on behalf of the 1st semester class regarding unfair marking",
             "We have sent multiple emails with no response regarding the feedback",
             "The lecturer is not responding to emails",
             "I am not satisfied with the service Regent is giving us"
-        ]
-    }
+        ),
+    ),
+)
+
+# Unambiguous keyword rules checked before calling Gemini: (regex, tag, confidence).
+# Matched case-insensitively against the newest message only: the start of the body up to
+# any quoted history, plus the subject unless it is a reply/forward. First hit wins.
+CLASSIFICATION_RULES = [
+    (r"^(automatic reply|auto[- ]?reply|out of office|undeliverable)\b", "general-inquiry", 0.95),
+    (r"\berror\s+C-LS-\d+", "technical-proctoring", 0.95),
+    (r"\baegrotat\b", "academic-exam", 0.9),
+    (r"\b(password\s+reset|reset\s+my\s+password|forgot\s+my\s+password)\b", "technical-access", 0.9),
+    (r"\bproof\s+of\s+payment\b", "finance-payment", 0.9),
+    # Only an explicit request; holds and missing marks need the model (fees, results)
+    (r"\b(?:request(?:ing)?|order(?:ing)?|need|send(?:\s+me)?)\s+(?:an?\s+|my\s+)?(?:official\s+)?transcripts?\b",
+     "admin-transcript", 0.9),
 ]
 
-GEMINI_MODEL = "gemini-2.5-flash-lite"
-GEMINI_API_URL = f"https://generativelanguage.googleapis.com/v1beta/models/{GEMINI_MODEL}:generateContent"
+GEMINI_MODEL: Final[str] = "gemini-2.5-flash-lite"
+GEMINI_API_URL: Final[str] = f"https://generativelanguage.googleapis.com/v1beta/models/{GEMINI_MODEL}:generateContent"
 
 
+@functools.lru_cache(maxsize=1)
 def get_classification_prompt():
+    """Return the classification prompt (built once - the tags are static)."""
+    return _build_classification_prompt()
+
+
+def _build_classification_prompt():
     """Generate the classification prompt with current tags and examples."""
-    tags_description = "\n".join([
-        f"- **{tag['name']}**: {tag['description']}"
-        for tag in CLASSIFICATION_TAGS
-    ])
-
-    examples_section = "\n\n".join([
-        f"**{tag['name'].upper()}** examples:\n" +
-        "\n".join([f'  - "{ex}"' for ex in tag['examples']])
-        for tag in CLASSIFICATION_TAGS
-    ])
-
-    valid_tags = ", ".join([tag['name'] for tag in CLASSIFICATION_TAGS])
+    tag_lines = []
+    example_blocks = []
+    names = []
+    for tag in CLASSIFICATION_TAGS:
+        tag_lines.append(f"- **{tag.name}**: {tag.description}")
+        example_blocks.append(tag.header + "\n" + tag.examples_block)
+        names.append(tag.name)
+
+    tags_description = "\n".join(tag_lines)
+    examples_section = "\n\n".join(example_blocks)
+    valid_tags = ", ".join(names)
 
     return f"""You are an email classification assistant for Regent University student support.
 Your task is to classify incoming emails into one of the following categories:
@@ -2,12 +2,134 @@
 D1 Database operations.
 """
 import json
+import os
+
 from js import console, JSON
+from pyodide.ffi import jsnull, to_js
 
+# Per-query logging; off in production since every console.log crosses into JS
+_DEBUG = os.environ.get("DATABASE_DEBUG") == "1"
 
-async def init_db(db):
-    """Initialize the database schema if needed."""
-    await db.prepare("""
+SQL_EMAIL_EXISTS = "SELECT 1 AS x FROM emails WHERE message_id = ? LIMIT 1"
+
+# Missing text fields are normalised here rather than in Python (NULLIF keeps
+# the old "empty subject" fallback)
+SQL_INSERT_EMAIL = """
+    INSERT INTO emails (
+        message_id, conversation_id, subject, snippet, body_text, from_address, from_name,
+        classification, confidence, reason, draft_reply, received_at
+    ) VALUES (
+        ?, COALESCE(?, ''), COALESCE(NULLIF(?, ''), '(No subject)'), COALESCE(?, ''),
+        COALESCE(?, ''), COALESCE(?, ''), COALESCE(?, ''),
+        ?, ?, COALESCE(?, ''), COALESCE(?, ''), COALESCE(?, '')
+    )
+    RETURNING id
+"""
+
+SQL_INSERT_LLM_USAGE = """
+    INSERT INTO llm_usage (email_id, model, operation, input_tokens, output_tokens, total_tokens)
+    VALUES (?, ?, ?, ?, ?, ?)
+    RETURNING id
+"""
+
+# Usage row for an email inserted earlier in the same batch, found by message_id
+SQL_INSERT_LLM_USAGE_FOR_MESSAGE = """
+    INSERT INTO llm_usage (email_id, model, operation, input_tokens, output_tokens, total_tokens)
+    VALUES ((SELECT id FROM emails WHERE message_id = ?), ?, ?, ?, ?, ?)
+"""
+
+SQL_LLM_USAGE_STATS = """
+    SELECT 
+        model,
+        operation,
+        COUNT(*) as count,
+        SUM(input_tokens) as total_input_tokens,
+        SUM(output_tokens) as total_output_tokens,
+        SUM(total_tokens) as total_tokens,
+        AVG(input_tokens) as avg_input_tokens,
+        AVG(output_tokens) as avg_output_tokens
+    FROM llm_usage
+    GROUP BY model, operation
+"""
+
+# Column order for each getter; the SELECT lists are built from these so the
+# positional rows returned by .raw() always line up with the keys
+_EMAIL_FIELDS = (
+    "id", "message_id", "conversation_id", "subject", "snippet", "from_address", "from_name",
+    "classification", "confidence", "reason", "draft_reply", "received_at", "processed_at",
+)
+_RECENT_FIELDS = (
+    "id", "message_id", "conversation_id", "subject", "classification", "confidence", "received_at",
+)
+_CONVERSATION_FIELDS = (
+    "id", "message_id", "conversation_id", "subject", "snippet", "from_address", "from_name",
+    "classification", "confidence", "received_at",
+)
+
+SQL_EMAIL_BY_MESSAGE_ID = f"""
+    SELECT {", ".join(_EMAIL_FIELDS)}
+    FROM emails WHERE message_id = ? LIMIT 1
+"""
+
+SQL_RECENT_EMAILS = f"""
+    SELECT {", ".join(_RECENT_FIELDS)}
+    FROM emails ORDER BY processed_at DESC LIMIT ?
+"""
+
+# json_group_object rejects NULL labels, so unclassified rows are left out
+SQL_CLASSIFICATION_STATS = """
+    SELECT json_group_object(classification, count) AS stats
+    FROM (
+        SELECT classification, COUNT(*) as count
+        FROM emails
+        WHERE classification IS NOT NULL
+        GROUP BY classification
+    )
+"""
+
+SQL_EMAILS_BY_CONVERSATION = f"""
+    SELECT {", ".join(_CONVERSATION_FIELDS)}
+    FROM emails WHERE conversation_id = ? ORDER BY received_at ASC
+"""
+
+SQL_CONVERSATION_STATS = """
+    SELECT json_group_array(json_object(
+        'conversation_id', conversation_id,
+        'message_count', message_count,
+        'classifications', json(classifications)
+    )) AS conversations
+    FROM (
+        SELECT 
+            conversation_id,
+            COUNT(*) as message_count,
+            json_group_array(DISTINCT classification)
+                FILTER (WHERE classification IS NOT NULL) as classifications
+        FROM emails
+        WHERE conversation_id IS NOT NULL AND conversation_id != ''
+        GROUP BY conversation_id
+        ORDER BY message_count DESC
+        LIMIT 100
+    )
+"""
+
+# Prepared statements by SQL text, with the js_id of the binding they were
+# prepared on. env.DB can be a new proxy per request, so proxy identity would
+# never match; js_id is the same for every proxy of one JS object.
+# bind() returns a new statement, so a cached one can be reused freely.
+_STMTS: dict = {}
+
+
+def _stmt(db, sql: str):
+    """Return a prepared statement for sql, preparing it once per D1 binding."""
+    cached = _STMTS.get(sql)
+    if cached is None or cached[0] != db.js_id:
+        cached = _STMTS[sql] = (db.js_id, db.prepare(sql))
+    return cached[1]
+
+
+# Schema DDL, applied in order by init_db. Every statement is idempotent.
+SCHEMA_STATEMENTS = (
+    """
         CREATE TABLE IF NOT EXISTS emails (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             message_id TEXT UNIQUE NOT NULL,
@@ -25,22 +147,19 @@ async def init_db(db):
             processed_at TEXT DEFAULT CURRENT_TIMESTAMP,
             created_at TEXT DEFAULT CURRENT_TIMESTAMP
         )
-    """).run()
-    
-    await db.prepare("""
-        CREATE INDEX IF NOT EXISTS idx_emails_message_id ON emails(message_id)
-    """).run()
-    
-    await db.prepare("""
-        CREATE INDEX IF NOT EXISTS idx_emails_classification ON emails(classification)
-    """).run()
-    
-    await db.prepare("""
-        CREATE INDEX IF NOT EXISTS idx_emails_conversation_id ON emails(conversation_id)
-    """).run()
-    
+    """,
+    # message_id is UNIQUE, so SQLite already indexes it; drop the duplicate
+    # index older deployments created
+    "DROP INDEX IF EXISTS idx_emails_message_id",
+    "CREATE INDEX IF NOT EXISTS idx_emails_classification ON emails(classification)",
+    # Serves both the conversation filter and its received_at ordering, which
+    # makes the old single-column conversation index redundant
+    "CREATE INDEX IF NOT EXISTS idx_emails_conv_received ON emails(conversation_id, received_at)",
+    "DROP INDEX IF EXISTS idx_emails_conversation_id",
+    # Lets get_recent_emails read the newest N rows instead of sorting the table
+    "CREATE INDEX IF NOT EXISTS idx_emails_processed_at ON emails(processed_at DESC)",
     # Token usage tracking table
-    await db.prepare("""
+    """
         CREATE TABLE IF NOT EXISTS llm_usage (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             email_id INTEGER NOT NULL,
@@ -52,37 +171,117 @@ async def init_db(db):
             created_at TEXT DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (email_id) REFERENCES emails(id)
         )
-    """).run()
-    
-    await db.prepare("""
-        CREATE INDEX IF NOT EXISTS idx_llm_usage_email_id ON llm_usage(email_id)
-    """).run()
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_llm_usage_email_id ON llm_usage(email_id)",
+)
+
+
+async def init_db(db):
+    """Initialize the database schema if needed (one D1 batch round trip)."""
+    # Deliberately unguarded: the only caller is the manual POST /init-db route,
+    # and re-running the idempotent DDL is how schema changes get applied
+    await db.batch(to_js([db.prepare(sql) for sql in SCHEMA_STATEMENTS]))
 
 
 async def email_exists(db, message_id: str) -> bool:
     """Check if an email has already been processed."""
-    result = await db.prepare(
-        "SELECT 1 FROM emails WHERE message_id = ?"
-    ).bind(message_id).first()
+    result = await _stmt(db, SQL_EMAIL_EXISTS).bind(message_id).first()
+    # With no row, first() can come back as None, jsnull or an empty proxy;
+    # a JsProxy of {} is truthy, so it is checked by content, not truthiness
+    if result is None or result is jsnull:
+        exists = False
+    else:
+        exists = JSON.stringify(result) not in ("null", "{}")
+    if _DEBUG:
+        console.log(f"email_exists {message_id[:50]}: {exists}")
+    return exists
+
+
+# Max bound parameters per IN (...) query, kept well under D1's limit
+EXISTS_CHUNK_SIZE = 100
+
+
+async def emails_existing(db, message_ids: list) -> set:
+    """Return the subset of message IDs that have already been processed."""
+    existing = set()
+    for start in range(0, len(message_ids), EXISTS_CHUNK_SIZE):
+        chunk = message_ids[start:start + EXISTS_CHUNK_SIZE]
+        placeholders = ",".join("?" * len(chunk))
+        result = await _stmt(
+            db, f"SELECT message_id FROM emails WHERE message_id IN ({placeholders})"
+        ).bind(*chunk).all()
+        if result.results:
+            existing.update(row.message_id for row in result.results)
+    return existing
+
+
+def _email_row(record: dict) -> tuple:
+    """Bind values for SQL_INSERT_EMAIL, in column order."""
+    get = record.get
+    return (
+        record["message_id"],
+        get("conversation_id"),
+        get("subject"),
+        get("snippet"),
+        get("body_text"),
+        get("from_address"),
+        get("from_name"),
+        record["classification"],
+        record["confidence"],
+        get("reason"),
+        get("draft_reply"),
+        get("received_at"),
+    )
+
+
+async def save_emails(db, records: list) -> list:
+    """
+    Save several processed emails in one D1 batch (a single round trip,
+    applied atomically). Returns the new row IDs in record order.
+    """
+    if not records:
+        return []
     
-    # Debug logging
-    console.log(f"email_exists check - result type: {type(result)}, result: {result}")
+    insert = _stmt(db, SQL_INSERT_EMAIL)
+    rows = [_email_row(record) for record in records]
+    if _DEBUG:
+        for row in rows:
+            console.log(f"Saving email: {row[0][:50]}, subject={(row[2] or '')[:30]}, class={row[7]}")
     
-    # D1 returns null/None if no row found
-    if result is None:
-        return False
+    # NULLs pick up the COALESCE defaults in SQL_INSERT_EMAIL
+    results = await db.batch(to_js([_bind(insert, row) for row in rows]))
     
-    # Convert JS result to check if it's actually a row
-    try:
-        # Try to stringify to see if there's actual data
-        result_str = JSON.stringify(result)
-        console.log(f"email_exists - stringified: {result_str}")
-        if result_str == "null" or result_str == "{}":
-            return False
-        return True
-    except Exception as e:
-        console.log(f"email_exists - error checking result: {e}")
-        return False
+    if _DEBUG:
+        console.log(f"Saved {len(rows)} email(s) successfully")
+    # Each batch result carries its RETURNING row
+    return [result.results[0].id if result.results else None for result in results]
+
+
+def _bind(statement, row):
+    # None would cross as undefined, which D1 rejects; send SQL NULL instead
+    return statement.bind(*[jsnull if value is None else value for value in row])
+
+
+async def save_email_with_usage(db, record: dict, usage: dict = None) -> int:
+    """
+    Save a processed email and, if given, its LLM usage in one D1 batch.
+    usage: {"model", "operation", "input_tokens", "output_tokens", "total_tokens"}
+    Returns the new email row ID.
+    """
+    statements = [_bind(_stmt(db, SQL_INSERT_EMAIL), _email_row(record))]
+    if usage:
+        statements.append(_bind(_stmt(db, SQL_INSERT_LLM_USAGE_FOR_MESSAGE), (
+            record["message_id"],
+            usage["model"],
+            usage["operation"],
+            usage.get("input_tokens", 0),
+            usage.get("output_tokens", 0),
+            usage.get("total_tokens", 0),
+        )))
+    
+    results = await db.batch(to_js(statements))
+    email_result = results[0]
+    return email_result.results[0].id if email_result.results else None
 
 
 async def save_email(
@@ -101,41 +300,21 @@ async def save_email(
     body_text: str = "",
 ) -> int:
     """Save a processed email to the database."""
-    # Ensure all values are strings (not None/undefined)
-    safe_draft = draft_reply if draft_reply else ""
-    safe_subject = subject if subject else "(No subject)"
-    safe_snippet = snippet if snippet else ""
-    safe_body_text = body_text if body_text else ""
-    safe_from_addr = from_address if from_address else ""
-    safe_from_name = from_name if from_name else ""
-    safe_reason = reason if reason else ""
-    safe_received = received_at if received_at else ""
-    safe_conversation_id = conversation_id if conversation_id else ""
-    
-    console.log(f"Saving email: {message_id[:50]}, subject={safe_subject[:30]}, class={classification}")
-    
-    result = await db.prepare("""
-        INSERT INTO emails (
-            message_id, conversation_id, subject, snippet, body_text, from_address, from_name,
-            classification, confidence, reason, draft_reply, received_at
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """).bind(
-        message_id,
-        safe_conversation_id,
-        safe_subject,
-        safe_snippet,
-        safe_body_text,
-        safe_from_addr,
-        safe_from_name,
-        classification,
-        confidence,
-        safe_reason,
-        safe_draft,
-        safe_received,
-    ).run()
-    
-    console.log(f"Email saved successfully")
-    return result.meta.last_row_id if result.meta else None
+    ids = await save_emails(db, [{
+        "message_id": message_id,
+        "conversation_id": conversation_id,
+        "subject": subject,
+        "snippet": snippet,
+        "body_text": body_text,
+        "from_address": from_address,
+        "from_name": from_name,
+        "classification": classification,
+        "confidence": confidence,
+        "reason": reason,
+        "draft_reply": draft_reply,
+        "received_at": received_at,
+    }])
+    return ids[0]
 
 
 async def save_llm_usage(
@@ -148,36 +327,21 @@ async def save_llm_usage(
     total_tokens: int,
 ) -> int:
     """Save LLM token usage for an email."""
-    result = await db.prepare("""
-        INSERT INTO llm_usage (email_id, model, operation, input_tokens, output_tokens, total_tokens)
-        VALUES (?, ?, ?, ?, ?, ?)
-    """).bind(
+    row = await _stmt(db, SQL_INSERT_LLM_USAGE).bind(
         email_id,
         model,
         operation,
         input_tokens,
         output_tokens,
         total_tokens,
-    ).run()
+    ).first()
     
-    return result.meta.last_row_id if result.meta else None
+    return row.id if row else None
 
 
 async def get_llm_usage_stats(db) -> dict:
     """Get LLM usage statistics."""
-    result = await db.prepare("""
-        SELECT 
-            model,
-            operation,
-            COUNT(*) as count,
-            SUM(input_tokens) as total_input_tokens,
-            SUM(output_tokens) as total_output_tokens,
-            SUM(total_tokens) as total_tokens,
-            AVG(input_tokens) as avg_input_tokens,
-            AVG(output_tokens) as avg_output_tokens
-        FROM llm_usage
-        GROUP BY model, operation
-    """).all()
+    result = await _stmt(db, SQL_LLM_USAGE_STATS).all()
     
     stats = []
     if result.results:
@@ -197,113 +361,36 @@ async def get_llm_usage_stats(db) -> dict:
 
 async def get_email_by_message_id(db, message_id: str) -> dict:
     """Get a processed email by its message ID."""
-    result = await db.prepare(
-        "SELECT * FROM emails WHERE message_id = ?"
-    ).bind(message_id).first()
+    rows = await _stmt(db, SQL_EMAIL_BY_MESSAGE_ID).bind(message_id).raw()
     
-    if result:
-        return {
-            "id": result.id,
-            "message_id": result.message_id,
-            "conversation_id": result.conversation_id,
-            "subject": result.subject,
-            "snippet": result.snippet,
-            "from_address": result.from_address,
-            "from_name": result.from_name,
-            "classification": result.classification,
-            "confidence": result.confidence,
-            "reason": result.reason,
-            "draft_reply": result.draft_reply,
-            "received_at": result.received_at,
-            "processed_at": result.processed_at,
-        }
+    if rows:
+        return dict(zip(_EMAIL_FIELDS, rows[0]))
     return None
 
 
 async def get_recent_emails(db, limit: int = 50) -> list:
     """Get recent processed emails."""
-    result = await db.prepare(
-        "SELECT * FROM emails ORDER BY processed_at DESC LIMIT ?"
-    ).bind(limit).all()
-    
-    emails = []
-    if result.results:
-        for row in result.results:
-            emails.append({
-                "id": row.id,
-                "message_id": row.message_id,
-                "conversation_id": row.conversation_id,
-                "subject": row.subject,
-                "classification": row.classification,
-                "confidence": row.confidence,
-                "received_at": row.received_at,
-            })
-    return emails
+    rows = await _stmt(db, SQL_RECENT_EMAILS).bind(limit).raw()
+    return [dict(zip(_RECENT_FIELDS, row)) for row in rows]
 
 
 async def get_classification_stats(db) -> dict:
     """Get classification statistics."""
-    result = await db.prepare("""
-        SELECT classification, COUNT(*) as count
-        FROM emails
-        GROUP BY classification
-    """).all()
-    
-    stats = {}
-    if result.results:
-        for row in result.results:
-            stats[row.classification] = row.count
-    return stats
+    row = await _stmt(db, SQL_CLASSIFICATION_STATS).first()
+    return json.loads(row.stats) if row else {}
 
 
 async def get_emails_by_conversation(db, conversation_id: str) -> list:
     """Get all emails in a conversation thread."""
-    result = await db.prepare(
-        "SELECT * FROM emails WHERE conversation_id = ? ORDER BY received_at ASC"
-    ).bind(conversation_id).all()
-    
-    emails = []
-    if result.results:
-        for row in result.results:
-            emails.append({
-                "id": row.id,
-                "message_id": row.message_id,
-                "conversation_id": row.conversation_id,
-                "subject": row.subject,
-                "snippet": row.snippet,
-                "from_address": row.from_address,
-                "from_name": row.from_name,
-                "classification": row.classification,
-                "confidence": row.confidence,
-                "received_at": row.received_at,
-            })
-    return emails
+    rows = await _stmt(db, SQL_EMAILS_BY_CONVERSATION).bind(conversation_id).raw()
+    return [dict(zip(_CONVERSATION_FIELDS, row)) for row in rows]
 
 
 async def get_conversation_stats(db) -> dict:
     """Get statistics grouped by conversation."""
-    result = await db.prepare("""
-        SELECT 
-            conversation_id,
-            COUNT(*) as message_count,
-            GROUP_CONCAT(DISTINCT classification) as classifications
-        FROM emails
-        WHERE conversation_id IS NOT NULL AND conversation_id != ''
-        GROUP BY conversation_id
-        ORDER BY message_count DESC
-        LIMIT 100
-    """).all()
-    
-    stats = {
-        "total_conversations": 0,
-        "conversations": []
+    row = await _stmt(db, SQL_CONVERSATION_STATS).first()
+    conversations = json.loads(row.conversations) if row else []
+    return {
+        "total_conversations": len(conversations),
+        "conversations": conversations,
     }
-    if result.results:
-        stats["total_conversations"] = len(result.results)
-        for row in result.results:
-            stats["conversations"].append({
-                "conversation_id": row.conversation_id,
-                "message_count": row.message_count,
-                "classifications": row.classifications.split(",") if row.classifications else [],
-            })
-    return stats
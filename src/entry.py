@@ -2,10 +2,14 @@
 Regent Support Email Automation Worker
 Handles MS Graph webhooks, classifies emails using Gemini, stores in D1.
 """
+import asyncio
 import json
+import os
+import time
+from collections import OrderedDict
 from urllib.parse import urlparse, parse_qs
 
-from js import console, Object, JSON
+from js import console, Object
 from pyodide.ffi import to_js as _to_js
 from workers import Response, WorkerEntrypoint
 
@@ -18,13 +22,12 @@ from msgraph import (
     delete_subscription,
     renew_subscription,
 )
-from classifier import classify_email
+from classifier import classify_emails_batch
 from presidio import mask_email_content, get_presidio_config
 from database import (
     init_db,
-    email_exists,
-    save_email,
-    save_llm_usage,
+    emails_existing,
+    save_email_with_usage,
     get_recent_emails,
     get_classification_stats,
     get_emails_by_conversation,
@@ -32,86 +35,147 @@ from database import (
     get_llm_usage_stats,
 )
 from config import GEMINI_MODEL
+from utils import extract_message_id
 
 
-def to_js(obj):
-    return _to_js(obj, dict_converter=Object.fromEntries)
+# Per-email step logs; otherwise each email gets one summary line
+_DEBUG = os.environ.get("WEBHOOK_DEBUG") == "1"
 
+# Body chars kept for masking, classification and storage; the tail is never used
+MAX_BODY_CHARS = 10000
 
-def js_to_py(js_obj):
-    """Convert JS object to Python dict via JSON serialization."""
-    return json.loads(JSON.stringify(js_obj))
+# Health check body, serialized once; served as-is on every probe
+_HEALTH_BODY = json.dumps({
+    "status": "ok",
+    "service": "regent-support-email-automation",
+})
+_JSON_HEADERS = {"content-type": "application/json"}
 
+# Max subscription renewals in flight during the scheduled run
+RENEW_MAX_CONCURRENCY = 10
 
-class Default(WorkerEntrypoint):
+# How long an applied (message_id, category) pair suppresses repeat PATCHes
+CATEGORY_DEDUP_TTL = 300
 
-    async def fetch(self, request):
-        url = urlparse(request.url)
-        path = url.path
-        method = request.method
+# (message_id, category) -> expiry time, per isolate
+_RECENT_CATEGORIES: dict[tuple, float] = {}
 
-        # Health check
-        if path == "/" and method == "GET":
-            return Response.json(to_js({
-                "status": "ok",
-                "service": "regent-support-email-automation",
-            }))
+# Message IDs known to be stored, so Graph redeliveries skip the D1 check
+SEEN_MAX = 4096
+_SEEN: OrderedDict = OrderedDict()
 
-        # MS Graph webhook validation (can come as GET or POST with validationToken)
-        if path == "/webhook":
-            params = parse_qs(url.query)
-            validation_token = params.get("validationToken", [None])[0]
-            if validation_token:
-                console.log(f"Webhook validation request received ({method})")
-                return Response(validation_token)
 
-            # If no validation token and it's GET, return error
-            if method == "GET":
-                return Response("Missing validationToken", status=400)
+def _mark_seen(message_id: str):
+    """Record a processed message ID, evicting the least recently seen."""
+    _SEEN[message_id] = None
+    _SEEN.move_to_end(message_id)
+    if len(_SEEN) > SEEN_MAX:
+        _SEEN.popitem(last=False)
 
-            # POST without validation token = actual notification
-            if method == "POST":
-                return await self._handle_webhook_notification(request)
 
-        # Manual subscription management endpoints
-        if path == "/subscriptions" and method == "GET":
-            return await self._list_subscriptions()
+def _truncate_body(body: str, limit: int = MAX_BODY_CHARS) -> str:
+    """Cut body to at most limit chars, preferring the last paragraph break in the second half."""
+    if not body or len(body) <= limit:
+        return body or ""
+    head = body[:limit]
+    cut = head.rfind("\n\n")
+    return head[:cut] if cut > limit // 2 else head
 
-        if path == "/subscriptions" and method == "POST":
-            return await self._create_subscription(request)
 
-        if path == "/subscriptions" and method == "DELETE":
-            return await self._delete_subscription(request)
+def to_js(obj):
+    return _to_js(obj, dict_converter=Object.fromEntries)
+
 
-        # Stats and recent emails
-        if path == "/stats" and method == "GET":
-            return await self._get_stats()
+async def _renew_one(access_token: str, sub_id: str, semaphore) -> tuple:
+    """Renew one subscription; returns (sub_id, ok, expiration) and never raises."""
+    async with semaphore:
+        try:
+            result = await renew_subscription(access_token, sub_id)
+        except Exception as e:
+            console.error(
+                f"Failed to renew subscription {sub_id[:20]}...: {e}")
+            return sub_id, False, None
+    expiration = result.get('expiration', 'unknown')
+    console.log(
+        f"Renewed subscription {sub_id[:20]}... - expires {expiration}")
+    return sub_id, True, expiration
 
-        if path == "/emails" and method == "GET":
-            return await self._get_recent_emails()
 
-        # Conversation endpoints
-        if path == "/conversations" and method == "GET":
-            return await self._get_conversation_stats()
+def _category_recently_applied(message_id: str, category_name: str) -> bool:
+    """Check whether a category was applied within CATEGORY_DEDUP_TTL."""
+    return _RECENT_CATEGORIES.get((message_id, category_name), 0) > time.monotonic()
 
-        if path.startswith("/conversation/") and method == "GET":
-            conversation_id = path[14:]  # Remove "/conversation/" prefix
-            return await self._get_conversation(conversation_id)
 
-        # Init DB (one-time setup)
-        if path == "/init-db" and method == "POST":
-            return await self._init_database()
+def _record_category_applied(message_id: str, category_name: str):
+    """Remember a successful category application for CATEGORY_DEDUP_TTL."""
+    now = time.monotonic()
+    # Drop expired entries before adding so the map stays small
+    for stale in [k for k, expires in _RECENT_CATEGORIES.items() if expires <= now]:
+        del _RECENT_CATEGORIES[stale]
+    _RECENT_CATEGORIES[(message_id, category_name)] = now + CATEGORY_DEDUP_TTL
 
-        # Presidio config status
-        if path == "/presidio-config" and method == "GET":
-            return Response.json(to_js({"presidio": get_presidio_config()}))
 
-        # LLM usage stats
-        if path == "/llm-usage" and method == "GET":
-            return await self._get_llm_usage()
+async def _apply_category(access_token: str, user_email: str, message_id: str, category_name: str) -> bool:
+    """Tag an email in Outlook (optional - may fail if no Mail.ReadWrite permission)."""
+    try:
+        if _DEBUG:
+            console.log(
+                f"Applying category '{category_name}' to email {message_id[:20]}...")
+        success = await apply_category_to_email(access_token, user_email, message_id, category_name)
+        # Only a successful PATCH suppresses repeats; a failed one is retried
+        # when Graph redelivers the notification
+        if success:
+            _record_category_applied(message_id, category_name)
+        else:
+            console.warn(
+                f"Failed to apply category '{category_name}' - check Mail.ReadWrite permission")
+        return success
+    except Exception as cat_err:
+        console.error(
+            f"Error applying category '{category_name}': {cat_err}")
+        return False
+
+
+class Default(WorkerEntrypoint):
+
+    async def fetch(self, request):
+        url = urlparse(request.url)
+        path = url.path
+        method = request.method
+
+        handler = ROUTES.get((method, path))
+        if handler:
+            return await handler(self, request, url)
+
+        for route_method, prefix, prefix_handler in PREFIX_ROUTES:
+            if method == route_method and path.startswith(prefix):
+                return await prefix_handler(self, path[len(prefix):])
 
         return Response("Not Found", status=404)
 
+    async def _health(self):
+        """Health check."""
+        return Response(_HEALTH_BODY, headers=_JSON_HEADERS)
+
+    async def _handle_webhook(self, request, url):
+        """MS Graph webhook validation (GET or POST with validationToken) or notification."""
+        params = parse_qs(url.query)
+        validation_token = params.get("validationToken", [None])[0]
+        if validation_token:
+            console.log(f"Webhook validation request received ({request.method})")
+            return Response(validation_token)
+
+        # If no validation token and it's GET, return error
+        if request.method == "GET":
+            return Response("Missing validationToken", status=400)
+
+        # POST without validation token = actual notification
+        return await self._handle_webhook_notification(request)
+
+    async def _get_presidio_config(self):
+        """Presidio config status."""
+        return Response.json(to_js({"presidio": get_presidio_config()}))
+
     async def _handle_webhook_notification(self, request):
         """Process incoming webhook notification from MS Graph."""
         try:
@@ -127,7 +191,8 @@ class Default(WorkerEntrypoint):
             # Validate client state
             expected_state = str(self.env.WEBHOOK_VALIDATION_TOKEN)
 
-            # Process each notification
+            # Collect message IDs first so the batch is fetched and classified together
+            message_ids = []
             for i in range(len(notifications)):
                 notification = notifications[i]
 
@@ -144,24 +209,23 @@ class Default(WorkerEntrypoint):
                     continue
 
                 resource = notification.get("resource", "")
-                console.log(f"Processing resource: {resource}")
+                if _DEBUG:
+                    console.log(f"Processing resource: {resource}")
 
-                # Extract message ID from resource path
-                # Format: users/{email}/mailFolders/inbox/messages/{message-id}
-                parts = resource.split("/")
-                message_id = None
-                for j in range(len(parts)):
-                    if parts[j].lower() == "messages" and j + 1 < len(parts):
-                        message_id = parts[j + 1]
-                        break
+                message_id = extract_message_id(resource)
 
                 if message_id:
-                    console.log(f"Processing message: {message_id[:50]}...")
-                    await self._process_email(message_id)
+                    if message_id not in message_ids:
+                        message_ids.append(message_id)
                 else:
                     console.warn(
                         f"Could not extract message ID from resource: {resource}")
 
+            # Graph only waits a few seconds for the 202, so the fetch/classify/store
+            # work continues after the response has been sent
+            if message_ids:
+                self.ctx.waitUntil(asyncio.create_task(self._process_emails(message_ids)))
+
             # MS Graph expects 202 Accepted
             return Response("", status=202)
 
@@ -170,107 +234,153 @@ class Default(WorkerEntrypoint):
             # Still return 202 to prevent retries
             return Response("", status=202)
 
-    async def _process_email(self, message_id: str):
-        """Fetch, classify, tag, and store an email."""
+    async def _process_emails(self, message_ids: list):
+        """Fetch, classify, tag, and store a batch of emails."""
         try:
             db = self.env.DB
+            started = time.monotonic()
 
-            # Check if already processed
-            if await email_exists(db, message_id):
-                console.log(f"Email {message_id} already processed, skipping")
+            # Redeliveries already handled by this isolate never reach D1
+            message_ids = [mid for mid in message_ids if mid not in _SEEN]
+            if not message_ids:
+                console.log("All notified emails already processed, skipping")
                 return
 
-            # Get access token
-            access_token = await get_access_token(
-                self.env.MS_TENANT_ID,
-                self.env.MS_CLIENT_ID,
-                self.env.MS_CLIENT_SECRET,
+            # The duplicate check (D1) and token fetch (HTTPS) are independent
+            existing, access_token = await asyncio.gather(
+                emails_existing(db, message_ids),
+                get_access_token(
+                    self.env.MS_TENANT_ID,
+                    self.env.MS_CLIENT_ID,
+                    self.env.MS_CLIENT_SECRET,
+                ),
             )
 
-            # Fetch email details
-            user_email = str(self.env.MS_USER_EMAIL)
-            email = await get_email_by_id(access_token, user_email, message_id)
+            # Skip anything already processed
+            for message_id in existing:
+                console.log(f"Email {message_id} already processed, skipping")
+                _mark_seen(message_id)
+            message_ids = [mid for mid in message_ids if mid not in existing]
+            if not message_ids:
+                return
 
-            console.log(
-                f"Processing email: {email.get('subject', 'No subject')}")
-            console.log(
-                f"Email data: from={email.get('from_address')}, received={email.get('received_datetime')}")
-
-            # Mask PII before sending to LLM (soft fail - uses original if masking fails)
-            masked = await mask_email_content(
-                subject=email.get("subject", ""),
-                body=email.get("body_content", ""),
-                from_name=email.get("from_name", ""),
-                from_address=email.get("from_address", ""),
+            # Fetch email details concurrently
+            user_email = str(self.env.MS_USER_EMAIL)
+            fetched = await asyncio.gather(
+                *[get_email_by_id(access_token, user_email, mid) for mid in message_ids],
+                return_exceptions=True,
             )
+            batch = []
+            for message_id, email in zip(message_ids, fetched):
+                if isinstance(email, Exception):
+                    console.error(f"Error fetching email {message_id}: {email}")
+                    continue
+                if _DEBUG:
+                    console.log(
+                        f"Processing email: {email.get('subject', 'No subject')}")
+                    console.log(
+                        f"Email data: from={email.get('from_address')}, received={email.get('received_datetime')}")
+                batch.append((message_id, email))
+            if not batch:
+                return
 
-            if masked["success"] and masked["total_entities_masked"] > 0:
-                console.log(
-                    f"PII masked for classification: {masked['total_entities_masked']} entities")
+            # Mask PII before sending to LLM (soft fail - uses original if masking fails).
+            # Only the part of the body that is kept gets masked
+            masked_batch = await asyncio.gather(*[
+                mask_email_content(
+                    subject=email.get("subject", ""),
+                    body=_truncate_body(email.get("body_content", "")),
+                    from_name=email.get("from_name", ""),
+                    from_address=email.get("from_address", ""),
+                )
+                for _, email in batch
+            ])
 
-            # Classify the email using masked content (protects PII from LLM)
-            classification_result = await classify_email(
+            # Classify the whole batch using masked content (protects PII from LLM)
+            classification_results = await classify_emails_batch(
                 self.env.GEMINI_API_KEY,
-                masked["subject"],
-                masked["body"],
+                [{"subject": masked["subject"], "body": masked["body"]} for masked in masked_batch],
             )
 
-            classification = classification_result.get(
-                "classification", "general")
-            confidence = classification_result.get("confidence", 0)
-            console.log(f"Classification: {classification} ({confidence})")
-
-            # Apply category to email in Outlook (optional - may fail if no Mail.ReadWrite permission)
-            try:
-                category_name = classification.replace('-', ' ').title()
-                console.log(
-                    f"Applying category '{category_name}' to email {message_id[:20]}...")
-                success = await apply_category_to_email(access_token, user_email, message_id, category_name)
-                if success:
-                    console.log(
-                        f"Category '{category_name}' applied successfully")
-                else:
-                    console.warn(
-                        f"Failed to apply category '{category_name}' - check Mail.ReadWrite permission")
-            except Exception as cat_err:
-                console.error(
-                    f"Error applying category '{category_name}': {cat_err}")
+            await asyncio.gather(*[
+                self._store_email(
+                    db, access_token, user_email, message_id, email, masked, classification_result, started)
+                for (message_id, email), masked, classification_result in zip(
+                    batch, masked_batch, classification_results)
+            ])
 
-            # Save to database (include full body text for reference)
+        except Exception as e:
+            console.error(f"Error processing emails {message_ids}: {e}")
+
+    async def _store_email(self, db, access_token, user_email, message_id, email, masked, classification_result, started):
+        """Tag and store one classified email, then log a single summary line for it."""
+        classification = classification_result.get("classification", "general")
+        confidence = classification_result.get("confidence", 0)
+        evt = {
+            "mid": message_id[:20],
+            "subj": (masked["subject"] or "")[:80],
+            "cls": classification,
+            "conf": confidence,
+            "masked": masked["total_entities_masked"] if masked["success"] else None,
+            "cat_ok": None,
+        }
+        category_task = None
+        try:
+            # Apply category to email in Outlook while the row is saved; it only
+            # needs the label. Skipped when the message already carries it or it
+            # was just applied (Graph often redelivers the same notification)
+            category_name = classification.replace('-', ' ').title()
+            if category_name in (email.get("categories") or []) or _category_recently_applied(
+                    message_id, category_name):
+                evt["cat_ok"] = "skipped"
+            else:
+                category_task = asyncio.create_task(
+                    _apply_category(access_token, user_email, message_id, category_name))
+
+            # Save to database (include full body text for reference); the email
+            # row and its token usage go to D1 in one batch
             reason = classification_result.get("reason", "") or "No reason"
-            email_id = await save_email(
+            token_usage = classification_result.get("token_usage")
+            await save_email_with_usage(
                 db,
-                message_id=message_id,
-                subject=email.get("subject", "") or "(No subject)",
-                snippet=(email.get("body_preview", "") or "")[:500],
-                from_address=email.get("from_address", "") or "",
-                from_name=email.get("from_name", "") or "",
-                classification=classification,
-                confidence=float(confidence),
-                reason=reason,
-                received_at=email.get("received_datetime", "") or "",
-                conversation_id=email.get("conversation_id", "") or "",
-                # Store cleaned body text (truncated)
-                body_text=masked["body"][:10000],
+                {
+                    "message_id": message_id,
+                    "subject": email.get("subject", "") or "(No subject)",
+                    "snippet": (email.get("body_preview", "") or "")[:500],
+                    "from_address": email.get("from_address", "") or "",
+                    "from_name": email.get("from_name", "") or "",
+                    "classification": classification,
+                    "confidence": float(confidence),
+                    "reason": reason,
+                    "received_at": email.get("received_datetime", "") or "",
+                    "conversation_id": email.get("conversation_id", "") or "",
+                    # Store cleaned body text (truncated)
+                    "body_text": masked["body"][:MAX_BODY_CHARS],
+                },
+                {
+                    "model": GEMINI_MODEL,
+                    "operation": "classification",
+                    "input_tokens": token_usage.get("input_tokens", 0),
+                    "output_tokens": token_usage.get("output_tokens", 0),
+                    "total_tokens": token_usage.get("total_tokens", 0),
+                } if token_usage else None,
             )
+            _mark_seen(message_id)
 
-            # Save token usage if available
-            token_usage = classification_result.get("token_usage")
-            if token_usage and email_id:
-                await save_llm_usage(
-                    db,
-                    email_id=email_id,
-                    model=GEMINI_MODEL,
-                    operation="classification",
-                    input_tokens=token_usage.get("input_tokens", 0),
-                    output_tokens=token_usage.get("output_tokens", 0),
-                    total_tokens=token_usage.get("total_tokens", 0),
-                )
+        except Exception as e:
+            evt["error"] = str(e)
 
-            console.log(f"Email {message_id} processed successfully")
+        # The category PATCH has been running while the rows were saved; it is
+        # awaited even if the save failed so its outcome is not lost
+        # (_apply_category never raises)
+        if category_task:
+            evt["cat_ok"] = await category_task
 
-        except Exception as e:
-            console.error(f"Error processing email {message_id}: {e}")
+        evt["ms"] = round((time.monotonic() - started) * 1000)
+        if "error" in evt:
+            console.error(json.dumps(evt))
+        else:
+            console.log(json.dumps(evt))
 
     async def _init_database(self):
         """Initialize the database schema."""
@@ -297,8 +407,7 @@ class Default(WorkerEntrypoint):
         """Create a new MS Graph webhook subscription."""
         try:
             # Get the worker URL from the request or body
-            js_body = await request.json()
-            body = js_to_py(js_body)
+            body = (await request.json()).to_py()
             webhook_url = body.get("webhook_url")
 
             if not webhook_url:
@@ -331,8 +440,7 @@ class Default(WorkerEntrypoint):
     async def _delete_subscription(self, request):
         """Delete an MS Graph webhook subscription."""
         try:
-            js_body = await request.json()
-            body = js_to_py(js_body)
+            body = (await request.json()).to_py()
             subscription_id = body.get("subscription_id")
 
             if not subscription_id:
@@ -414,21 +522,45 @@ class Default(WorkerEntrypoint):
             subscriptions = await list_subscriptions(access_token)
             console.log(f"Found {len(subscriptions)} subscription(s) to renew")
 
-            renewed_count = 0
-            for sub in subscriptions:
-                sub_id = sub.get("id")
-                if sub_id:
-                    try:
-                        result = await renew_subscription(access_token, sub_id)
-                        console.log(
-                            f"Renewed subscription {sub_id[:20]}... - expires {result.get('expiration', 'unknown')}")
-                        renewed_count += 1
-                    except Exception as e:
-                        console.error(
-                            f"Failed to renew subscription {sub_id[:20]}...: {e}")
+            # Renew in parallel, capped to stay clear of Graph throttling
+            semaphore = asyncio.Semaphore(RENEW_MAX_CONCURRENCY)
+            results = await asyncio.gather(*[
+                _renew_one(access_token, sub["id"], semaphore)
+                for sub in subscriptions if sub.get("id")
+            ])
+            renewed_count = sum(1 for _, ok, _ in results if ok)
 
             console.log(
                 f"Subscription renewal complete: {renewed_count}/{len(subscriptions)} renewed")
 
         except Exception as e:
             console.error(f"Scheduled subscription renewal failed: {e}")
+
+
+# (method, path) -> handler(self, request, url), built once at import
+ROUTES = {
+    ("GET", "/"): lambda self, request, url: self._health(),
+    # MS Graph webhook validation can come as GET or POST
+    ("GET", "/webhook"): Default._handle_webhook,
+    ("POST", "/webhook"): Default._handle_webhook,
+    # Manual subscription management endpoints
+    ("GET", "/subscriptions"): lambda self, request, url: self._list_subscriptions(),
+    ("POST", "/subscriptions"): lambda self, request, url: self._create_subscription(request),
+    ("DELETE", "/subscriptions"): lambda self, request, url: self._delete_subscription(request),
+    # Stats and recent emails
+    ("GET", "/stats"): lambda self, request, url: self._get_stats(),
+    ("GET", "/emails"): lambda self, request, url: self._get_recent_emails(),
+    # Conversation endpoints
+    ("GET", "/conversations"): lambda self, request, url: self._get_conversation_stats(),
+    # Init DB (one-time setup)
+    ("POST", "/init-db"): lambda self, request, url: self._init_database(),
+    # Presidio config status
+    ("GET", "/presidio-config"): lambda self, request, url: self._get_presidio_config(),
+    # LLM usage stats
+    ("GET", "/llm-usage"): lambda self, request, url: self._get_llm_usage(),
+}
+
+# (method, path prefix, handler(self, path_tail)), checked in order after ROUTES
+PREFIX_ROUTES = (
+    ("GET", "/conversation/", Default._get_conversation),
+)
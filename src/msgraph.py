@@ -1,52 +1,113 @@
 """
 Microsoft Graph API helper functions.
 """
+import asyncio
+import functools
 import json
-from js import fetch, Object, console, JSON
+import time
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlencode
+from js import fetch, Object, console
 from pyodide.ffi import to_js as _to_js
 
 def to_js(obj):
     return _to_js(obj, dict_converter=Object.fromEntries)
 
-def js_to_py(js_obj):
-    """Convert JS object to Python dict via JSON serialization."""
-    return json.loads(JSON.stringify(js_obj))
-
-def safe_get(obj, *keys, default=None):
-    """Safely get nested values from JS or Python objects."""
-    current = obj
+def safe_get(data, *keys, default=None):
+    """Safely get a nested value from converted (plain dict) JSON."""
+    current = data
     for key in keys:
-        try:
-            if hasattr(current, 'get'):
-                current = current.get(key, default)
-            elif hasattr(current, key):
-                current = getattr(current, key, default)
-            elif isinstance(current, (list, tuple)) and isinstance(key, int):
-                current = current[key] if len(current) > key else default
-            elif hasattr(current, '__getitem__'):
-                current = current[key]
-            else:
-                return default
-            if current is None:
-                return default
-        except (KeyError, IndexError, TypeError, AttributeError):
+        if not isinstance(current, dict):
+            return default
+        current = current.get(key)
+        if current is None:
             return default
     return current
 
 GRAPH_BASE_URL = "https://graph.microsoft.com/v1.0"
 AUTH_URL = "https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token"
 
+# Max ~3 days for messages
+SUBSCRIPTION_EXPIRATION_MINUTES = 4230
+
+
+# JS header objects for the current access token, keyed by (access_token, text_body)
+_GRAPH_HEADERS: dict[tuple, object] = {}
+
+
+def _graph_headers(access_token: str, text_body: bool = False):
+    """
+    Return the converted Graph request headers for access_token, built once per token.
+    text_body asks Graph to return message bodies as plain text instead of HTML.
+    """
+    key = (access_token, text_body)
+    headers = _GRAPH_HEADERS.get(key)
+    if headers is None:
+        # Drop headers built for a previous token
+        if any(token != access_token for token, _ in _GRAPH_HEADERS):
+            _GRAPH_HEADERS.clear()
+        headers = {
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/json",
+        }
+        if text_body:
+            headers["Prefer"] = 'outlook.body-content-type="text"'
+        headers = _GRAPH_HEADERS[key] = to_js(headers)
+    return headers
+
+
+def _expiration_str(expiration_minutes: int) -> str:
+    """RFC 3339 UTC timestamp expiration_minutes from now, as Graph expects."""
+    delta = timedelta(minutes=expiration_minutes)
+    return (datetime.now(timezone.utc) + delta).isoformat(timespec="seconds").replace("+00:00", "Z")
+
+
+# Seconds of validity a cached token must have left to be reused
+TOKEN_EXPIRY_MARGIN = 60
+
+# Per-isolate token cache: (tenant_id, client_id) -> (access_token, expires_at)
+_TOKEN_CACHE: dict[tuple, tuple] = {}
+_TOKEN_LOCKS: dict[tuple, asyncio.Lock] = {}
+
 
 async def get_access_token(tenant_id: str, client_id: str, client_secret: str) -> str:
-    """Get OAuth2 access token for MS Graph API using client credentials flow."""
+    """
+    Get OAuth2 access token for MS Graph API using client credentials flow.
+    Tokens are cached until shortly before they expire; concurrent callers
+    share a single refresh.
+    """
+    key = (str(tenant_id), str(client_id))
+    cached = _TOKEN_CACHE.get(key)
+    if cached and time.time() < cached[1] - TOKEN_EXPIRY_MARGIN:
+        return cached[0]
+
+    lock = _TOKEN_LOCKS.setdefault(key, asyncio.Lock())
+    async with lock:
+        # Another caller may have refreshed while we waited
+        cached = _TOKEN_CACHE.get(key)
+        if cached and time.time() < cached[1] - TOKEN_EXPIRY_MARGIN:
+            return cached[0]
+        access_token, expires_in = await _fetch_access_token(tenant_id, client_id, client_secret)
+        _TOKEN_CACHE[key] = (access_token, time.time() + expires_in)
+        return access_token
+
+
+@functools.lru_cache(maxsize=4)
+def _token_request(tenant_id: str, client_id: str, client_secret: str) -> tuple:
+    """Token endpoint URL and form body; urlencode escapes secrets containing +, = or &."""
     url = AUTH_URL.format(tenant_id=tenant_id)
-    
-    body = (
-        f"client_id={client_id}"
-        f"&client_secret={client_secret}"
-        f"&scope=https://graph.microsoft.com/.default"
-        f"&grant_type=client_credentials"
-    )
+    body = urlencode({
+        "client_id": client_id,
+        "client_secret": client_secret,
+        "scope": "https://graph.microsoft.com/.default",
+        "grant_type": "client_credentials",
+    })
+    return url, body
+
+
+async def _fetch_access_token(tenant_id: str, client_id: str, client_secret: str) -> tuple:
+    """Request a new token; returns (access_token, expires_in seconds)."""
+    url, body = _token_request(str(tenant_id), str(client_id), str(client_secret))
     
     response = await fetch(
         url,
@@ -63,24 +124,21 @@ async def get_access_token(tenant_id: str, client_id: str, client_secret: str) -
         error_text = await response.text()
         raise Exception(f"Failed to get access token: {response.status} - {error_text}")
     
-    js_data = await response.json()
-    data = js_to_py(js_data)
-    return data.get("access_token")
+    data = (await response.json()).to_py()
+    return data.get("access_token"), int(data.get("expires_in", 3600))
 
 
 async def get_email_by_id(access_token: str, user_email: str, message_id: str) -> dict:
     """Fetch a specific email by ID."""
-    # Must explicitly request body field - MS Graph doesn't return it by default
+    # Must explicitly request body field - MS Graph doesn't return it by default.
+    # Plain-text bodies are much smaller than HTML and need no tag stripping.
     url = f"{GRAPH_BASE_URL}/users/{user_email}/messages/{message_id}?$select=id,conversationId,subject,bodyPreview,body,from,receivedDateTime,categories"
     
     response = await fetch(
         url,
         to_js({
             "method": "GET",
-            "headers": {
-                "Authorization": f"Bearer {access_token}",
-                "Content-Type": "application/json",
-            },
+            "headers": _graph_headers(access_token, text_body=True),
         })
     )
     
@@ -88,21 +146,16 @@ async def get_email_by_id(access_token: str, user_email: str, message_id: str) -
         error_text = await response.text()
         raise Exception(f"Failed to get email: {response.status} - {error_text}")
     
-    js_data = await response.json()
-    data = js_to_py(js_data)
-    
-    from_data = data.get("from", {})
-    from_email = from_data.get("emailAddress", {}) if from_data else {}
-    body_data = data.get("body", {})
+    data = (await response.json()).to_py()
     
     return {
         "id": data.get("id", ""),
         "conversation_id": data.get("conversationId", ""),
         "subject": data.get("subject", ""),
         "body_preview": data.get("bodyPreview", ""),
-        "body_content": body_data.get("content", "") if body_data else "",
-        "from_address": from_email.get("address", "") if from_email else "",
-        "from_name": from_email.get("name", "") if from_email else "",
+        "body_content": safe_get(data, "body", "content", default=""),
+        "from_address": safe_get(data, "from", "emailAddress", "address", default=""),
+        "from_name": safe_get(data, "from", "emailAddress", "name", default=""),
         "received_datetime": data.get("receivedDateTime", ""),
         "categories": data.get("categories", []),
     }
@@ -116,10 +169,7 @@ async def apply_category_to_email(access_token: str, user_email: str, message_id
         url,
         to_js({
             "method": "PATCH",
-            "headers": {
-                "Authorization": f"Bearer {access_token}",
-                "Content-Type": "application/json",
-            },
+            "headers": _graph_headers(access_token),
             "body": json.dumps({"categories": [category]}),
         })
     )
@@ -137,16 +187,13 @@ async def create_subscription(
     user_email: str,
     webhook_url: str,
     client_state: str,
-    expiration_minutes: int = 4230  # Max ~3 days for messages
+    expiration_minutes: int = SUBSCRIPTION_EXPIRATION_MINUTES
 ) -> dict:
     """
     Create a webhook subscription for new emails.
     NOTE: Call this AFTER deployment to register the webhook.
     """
-    from datetime import datetime, timedelta, timezone
-    
-    expiration = datetime.now(timezone.utc) + timedelta(minutes=expiration_minutes)
-    expiration_str = expiration.strftime("%Y-%m-%dT%H:%M:%S.0000000Z")
+    expiration_str = _expiration_str(expiration_minutes)
     
     url = f"{GRAPH_BASE_URL}/subscriptions"
     
@@ -162,10 +209,7 @@ async def create_subscription(
         url,
         to_js({
             "method": "POST",
-            "headers": {
-                "Authorization": f"Bearer {access_token}",
-                "Content-Type": "application/json",
-            },
+            "headers": _graph_headers(access_token),
             "body": json.dumps(payload),
         })
     )
@@ -174,8 +218,7 @@ async def create_subscription(
         error_text = await response.text()
         raise Exception(f"Failed to create subscription: {response.status} - {error_text}")
     
-    js_data = await response.json()
-    data = js_to_py(js_data)
+    data = (await response.json()).to_py()
     return {
         "id": data.get("id", ""),
         "resource": data.get("resource", ""),
@@ -184,12 +227,13 @@ async def create_subscription(
     }
 
 
-async def renew_subscription(access_token: str, subscription_id: str, expiration_minutes: int = 4230) -> dict:
+async def renew_subscription(
+    access_token: str,
+    subscription_id: str,
+    expiration_minutes: int = SUBSCRIPTION_EXPIRATION_MINUTES,
+) -> dict:
     """Renew an existing subscription."""
-    from datetime import datetime, timedelta, timezone
-    
-    expiration = datetime.now(timezone.utc) + timedelta(minutes=expiration_minutes)
-    expiration_str = expiration.strftime("%Y-%m-%dT%H:%M:%S.0000000Z")
+    expiration_str = _expiration_str(expiration_minutes)
     
     url = f"{GRAPH_BASE_URL}/subscriptions/{subscription_id}"
     
@@ -199,10 +243,7 @@ async def renew_subscription(access_token: str, subscription_id: str, expiration
         url,
         to_js({
             "method": "PATCH",
-            "headers": {
-                "Authorization": f"Bearer {access_token}",
-                "Content-Type": "application/json",
-            },
+            "headers": _graph_headers(access_token),
             "body": json.dumps(payload),
         })
     )
@@ -211,8 +252,7 @@ async def renew_subscription(access_token: str, subscription_id: str, expiration
         error_text = await response.text()
         raise Exception(f"Failed to renew subscription: {response.status} - {error_text}")
     
-    js_data = await response.json()
-    data = js_to_py(js_data)
+    data = (await response.json()).to_py()
     return {
         "id": data.get("id", ""),
         "expiration": data.get("expirationDateTime", ""),
@@ -227,9 +267,7 @@ async def delete_subscription(access_token: str, subscription_id: str) -> bool:
         url,
         to_js({
             "method": "DELETE",
-            "headers": {
-                "Authorization": f"Bearer {access_token}",
-            },
+            "headers": _graph_headers(access_token),
         })
     )
     
@@ -237,31 +275,30 @@ async def delete_subscription(access_token: str, subscription_id: str) -> bool:
 
 
 async def list_subscriptions(access_token: str) -> list:
-    """List all active subscriptions."""
+    """List all active subscriptions, following @odata.nextLink pages."""
     url = f"{GRAPH_BASE_URL}/subscriptions"
-    
-    response = await fetch(
-        url,
-        to_js({
-            "method": "GET",
-            "headers": {
-                "Authorization": f"Bearer {access_token}",
-                "Content-Type": "application/json",
-            },
-        })
-    )
-    
-    if not response.ok:
-        error_text = await response.text()
-        raise Exception(f"Failed to list subscriptions: {response.status} - {error_text}")
-    
-    js_data = await response.json()
-    data = js_to_py(js_data)
+    headers = _graph_headers(access_token)
     subscriptions = []
-    for sub in data.get("value", []):
-        subscriptions.append({
-            "id": sub.get("id", ""),
-            "resource": sub.get("resource", ""),
-            "expiration": sub.get("expirationDateTime", ""),
-        })
+    
+    while url:
+        response = await fetch(
+            url,
+            to_js({
+                "method": "GET",
+                "headers": headers,
+            })
+        )
+        
+        if not response.ok:
+            error_text = await response.text()
+            raise Exception(f"Failed to list subscriptions: {response.status} - {error_text}")
+        
+        data = (await response.json()).to_py()
+        for sub in data.get("value", []):
+            subscriptions.append({
+                "id": sub.get("id", ""),
+                "resource": sub.get("resource", ""),
+                "expiration": sub.get("expirationDateTime", ""),
+            })
+        url = data.get("@odata.nextLink")
     return subscriptions
@@ -2,10 +2,15 @@
 Presidio PII masking service.
 Soft-fail design - if Presidio is unavailable, returns original text.
 """
+import asyncio
+import functools
 import json
-from js import fetch, Object, console, JSON
+import re
+import time
+from js import fetch, Object, console, AbortSignal
 from pyodide.ffi import to_js as _to_js
 
+from fast_mask import fast_mask
 from utils import strip_html
 
 
@@ -13,18 +18,68 @@ def to_js(obj):
     return _to_js(obj, dict_converter=Object.fromEntries)
 
 
-def js_to_py(js_obj):
-    """Convert JS object to Python dict via JSON serialization."""
-    return json.loads(JSON.stringify(js_obj))
+# Request headers shared by every Presidio call, converted once
+_JSON_HEADERS = to_js({"Content-Type": "application/json"})
+
+
+# Joins the email fields so they are analyzed and anonymized in one request
+# each; the record separator is never part of a detected entity
+_FIELD_SEP = "\n\x1e\n"
+
+
+# Text with none of these cannot hold an email, phone, ID number or a
+# capitalised name, so the analyzer would find nothing in it
+_PII_CANDIDATE_RE = re.compile(r"[@\dA-Z]")
+
+# Circuit breaker per Presidio service: after BREAKER_THRESHOLD consecutive
+# failures, calls soft-fail immediately until BREAKER_COOLDOWN seconds pass
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 30
+_BREAKERS = {
+    "analyzer": {"fails": 0, "opened_at": 0.0, "probe_at": 0.0},
+    "anonymizer": {"fails": 0, "opened_at": 0.0, "probe_at": 0.0},
+}
+
+
+def _breaker_open(service: str) -> bool:
+    """
+    True while the service's breaker is open. After the cooldown (half-open),
+    only the first caller gets through to probe it; the rest see it open until
+    the probe is recorded. A probe that never reports back is abandoned after
+    another cooldown, so the breaker cannot stick half-open.
+    """
+    state = _BREAKERS[service]
+    if state["fails"] < BREAKER_THRESHOLD:
+        return False
+    now = time.monotonic()
+    if now - state["opened_at"] < BREAKER_COOLDOWN or now - state["probe_at"] < BREAKER_COOLDOWN:
+        return True
+    state["probe_at"] = now
+    return False
+
+
+def _breaker_record(service: str, ok: bool):
+    state = _BREAKERS[service]
+    state["probe_at"] = 0.0
+    if ok:
+        state["fails"] = 0
+    else:
+        state["fails"] += 1
+        state["opened_at"] = time.monotonic()
 
 
 # Presidio configuration
 PRESIDIO_CONFIG = {
     "enabled": True,
+    # "regex": local fast_mask patterns only; "nlp": also call the Presidio
+    # service, which is what catches free-text entities like PERSON
+    "mode": "nlp",
     "analyzer_url": "https://analyzer-gqabp4wdwtvje.azurewebsites.net",
     "anonymizer_url": "https://webapp-gqabp4wdwtvje.azurewebsites.net",
     "timeout_ms": 10000,  # 10 second timeout
     "score_threshold": 0.7,
+    # EMAIL_ADDRESS is gated on "@", so for email content (already through
+    # fast_mask) it is only requested when a Regent address is left
     "entities": ["EMAIL_ADDRESS", "PHONE_NUMBER", "PERSON", "ZA_ID_NUMBER"],
     "regent_domains": ["@regent.ac.za", "@myregent.ac.za"],
     # South African ID Number recognizer
@@ -44,6 +99,35 @@ PRESIDIO_CONFIG = {
 }
 
 
+# Cheap local checks per entity type: when one finds nothing, that entity is
+# left out of the analyzer request (and the ZA ID recognizer is not sent)
+_ENTITY_GATES = {
+    "EMAIL_ADDRESS": re.compile(r"@"),
+    "PHONE_NUMBER": re.compile(r"\d"),
+    "ZA_ID_NUMBER": re.compile(PRESIDIO_CONFIG["za_id_recognizer"]["patterns"][0]["regex"]),
+}
+
+
+@functools.lru_cache(maxsize=16)
+def _analyzer_body_tail(entities: tuple, score_threshold: float) -> str:
+    """
+    Serialized analyzer payload without its "text" field and opening brace.
+    Only the text changes per call, so the recognizer block is encoded once.
+    """
+    payload = {
+        "language": "en",
+        "entities": list(entities),
+        "score_threshold": score_threshold,
+    }
+    if "ZA_ID_NUMBER" in entities:
+        payload["ad_hoc_recognizers"] = [PRESIDIO_CONFIG["za_id_recognizer"]]
+    return json.dumps(payload)[1:]
+
+
+# Lower-cased Regent domains as a tuple, for str.endswith
+_REGENT_DOMAINS = tuple(domain.lower() for domain in PRESIDIO_CONFIG["regent_domains"])
+
+
 async def analyze_text(text: str) -> list:
     """
     Call Presidio analyzer to detect PII entities.
@@ -52,49 +136,64 @@ async def analyze_text(text: str) -> list:
     if not PRESIDIO_CONFIG["enabled"]:
         return []
     
+    entities = tuple(
+        entity for entity in PRESIDIO_CONFIG["entities"]
+        if entity not in _ENTITY_GATES or _ENTITY_GATES[entity].search(text)
+    )
+    if not entities:
+        return []
+    
+    if _breaker_open("analyzer"):
+        return []
+    
     try:
         url = f"{PRESIDIO_CONFIG['analyzer_url']}/analyze"
         
-        payload = {
-            "text": text,
-            "language": "en",
-            "entities": PRESIDIO_CONFIG["entities"],
-            "score_threshold": PRESIDIO_CONFIG["score_threshold"],
-            "ad_hoc_recognizers": [PRESIDIO_CONFIG["za_id_recognizer"]],
-        }
+        body = '{"text": ' + json.dumps(text) + ", " + _analyzer_body_tail(
+            entities, PRESIDIO_CONFIG["score_threshold"])
         
         response = await fetch(
             url,
             to_js({
                 "method": "POST",
-                "headers": {"Content-Type": "application/json"},
-                "body": json.dumps(payload),
-                "signal": None,  # Could add AbortController for timeout
+                "headers": _JSON_HEADERS,
+                "body": body,
+                "signal": AbortSignal.timeout(PRESIDIO_CONFIG["timeout_ms"]),
             })
         )
         
         if not response.ok:
             console.warn(f"Presidio analyzer error: {response.status}")
+            _breaker_record("analyzer", False)
             return []
         
-        js_data = await response.json()
-        return js_to_py(js_data)
+        analyzer_results = (await response.json()).to_py()
+        _breaker_record("analyzer", True)
+        return analyzer_results
     
     except Exception as e:
         console.warn(f"Presidio analyzer failed (soft fail): {e}")
+        _breaker_record("analyzer", False)
         return []
 
 
 def filter_regent_emails(text: str, analyzer_results: list) -> list:
     """Filter out Regent email addresses from masking."""
-    filtered = []
-    for result in analyzer_results:
-        if result.get("entity_type") == "EMAIL_ADDRESS":
-            email_text = text[result["start"]:result["end"]].lower()
-            if any(domain in email_text for domain in PRESIDIO_CONFIG["regent_domains"]):
-                continue  # Skip Regent emails
-        filtered.append(result)
-    return filtered
+    if not any(result.get("entity_type") == "EMAIL_ADDRESS" for result in analyzer_results):
+        return list(analyzer_results)
+    
+    # Lower-cased once for all matches; a few characters change length when
+    # lowered, and then offsets only line up with the original
+    text_lower = text.lower()
+    offsets_match = len(text_lower) == len(text)
+    regent_domains = _REGENT_DOMAINS
+    return [
+        result for result in analyzer_results
+        if not (result.get("entity_type") == "EMAIL_ADDRESS" and (
+            text_lower[result["start"]:result["end"]] if offsets_match
+            else text[result["start"]:result["end"]].lower()
+        ).endswith(regent_domains))  # Skip Regent emails
+    ]
 
 
 async def anonymize_text(text: str, analyzer_results: list) -> str:
@@ -106,11 +205,17 @@ async def anonymize_text(text: str, analyzer_results: list) -> str:
         return text
     
     # Filter out Regent emails
-    filtered_results = filter_regent_emails(text, analyzer_results)
-    
+    return await _anonymize_filtered(text, filter_regent_emails(text, analyzer_results))
+
+
+async def _anonymize_filtered(text: str, filtered_results: list) -> str:
+    """anonymize_text for results that have already been through filter_regent_emails."""
     if not filtered_results:
         return text
     
+    if _breaker_open("anonymizer"):
+        return text
+    
     try:
         url = f"{PRESIDIO_CONFIG['anonymizer_url']}/anonymize"
         
@@ -123,21 +228,24 @@ async def anonymize_text(text: str, analyzer_results: list) -> str:
             url,
             to_js({
                 "method": "POST",
-                "headers": {"Content-Type": "application/json"},
+                "headers": _JSON_HEADERS,
                 "body": json.dumps(payload),
+                "signal": AbortSignal.timeout(PRESIDIO_CONFIG["timeout_ms"]),
             })
         )
         
         if not response.ok:
             console.warn(f"Presidio anonymizer error: {response.status}")
+            _breaker_record("anonymizer", False)
             return text
         
-        js_data = await response.json()
-        data = js_to_py(js_data)
+        data = (await response.json()).to_py()
+        _breaker_record("anonymizer", True)
         return data.get("text", text)
     
     except Exception as e:
         console.warn(f"Presidio anonymizer failed (soft fail): {e}")
+        _breaker_record("anonymizer", False)
         return text
 
 
@@ -170,6 +278,10 @@ async def mask_pii(text: str) -> dict:
     if not text or not text.strip():
         return result
     
+    if not _PII_CANDIDATE_RE.search(text):
+        result["success"] = True  # Nothing that could be PII
+        return result
+    
     try:
         # Analyze
         analyzer_results = await analyze_text(text)
@@ -184,7 +296,7 @@ async def mask_pii(text: str) -> dict:
         result["entities_masked"] = len(filtered_results)
         
         # Anonymize
-        masked_text = await anonymize_text(text, analyzer_results)
+        masked_text = await _anonymize_filtered(text, filtered_results)
         result["masked_text"] = masked_text
         result["success"] = True
         
@@ -216,50 +328,57 @@ async def mask_email_content(subject: str, body: str, from_name: str = "", from_
             "success": bool,
         }
     """
-    # Strip HTML from body (MS Graph returns HTML content)
+    # Strip HTML from body before any masking, so neither fast_mask nor the
+    # analyzer scans markup (bodies are fetched as plain text, but HTML callers
+    # and tag-like fragments still pass through here)
     clean_body = strip_html(body)
     
+    # Structured identifiers are masked locally first, so they never leave
+    # the worker even if the Presidio service is down
+    masked_subject, subject_count = fast_mask(subject, _REGENT_DOMAINS)
+    masked_body, body_count = fast_mask(clean_body, _REGENT_DOMAINS)
+    masked_name, name_count = fast_mask(from_name, _REGENT_DOMAINS)
+    masked_address, address_count = fast_mask(from_address, _REGENT_DOMAINS)
+    fast_count = subject_count + body_count + name_count + address_count
+    
     result = {
-        "subject": subject,
-        "body": clean_body,
-        "from_name": from_name,
-        "from_address": from_address,
+        "subject": masked_subject,
+        "body": masked_body,
+        "from_name": masked_name,
+        "from_address": masked_address,
         "original_subject": subject,
         "original_body": body,
-        "total_entities_found": 0,
-        "total_entities_masked": 0,
+        "total_entities_found": fast_count,
+        "total_entities_masked": fast_count,
         "success": False,
     }
     
-    if not PRESIDIO_CONFIG["enabled"]:
+    if not PRESIDIO_CONFIG["enabled"] or PRESIDIO_CONFIG["mode"] != "nlp":
+        result["success"] = True
         return result
     
     try:
-        # Mask subject
-        subject_result = await mask_pii(subject)
-        result["subject"] = subject_result["masked_text"]
-        result["total_entities_found"] += subject_result["entities_found"]
-        result["total_entities_masked"] += subject_result["entities_masked"]
-        
-        # Mask body (already HTML-stripped)
-        body_result = await mask_pii(clean_body)
-        result["body"] = body_result["masked_text"]
-        result["total_entities_found"] += body_result["entities_found"]
-        result["total_entities_masked"] += body_result["entities_masked"]
-        
-        # Mask from_name if provided
-        if from_name:
-            name_result = await mask_pii(from_name)
-            result["from_name"] = name_result["masked_text"]
-            result["total_entities_found"] += name_result["entities_found"]
-            result["total_entities_masked"] += name_result["entities_masked"]
+        # Subject, body, from name and from address share one analyze and one
+        # anonymize round trip (Graph can return a null subject or name)
+        fields = [masked_subject or "", masked_body or "", masked_name or "", masked_address or ""]
+        combined_result = await mask_pii(_FIELD_SEP.join(fields))
+        parts = combined_result["masked_text"].split(_FIELD_SEP)
+        if len(parts) == len(fields):
+            field_results = [combined_result]
+        else:
+            # An entity swallowed a separator; mask the fields separately,
+            # concurrently, sending identical fields (a name repeated as the
+            # subject, empty fields) only once
+            console.warn("Combined PII masking lost field boundaries, masking fields separately")
+            unique = list(dict.fromkeys(fields))
+            by_text = dict(zip(unique, await asyncio.gather(*[mask_pii(field) for field in unique])))
+            field_results = [by_text[field] for field in fields]
+            parts = [field_result["masked_text"] for field_result in field_results]
         
-        # Mask from_address (will preserve Regent emails due to filter)
-        if from_address:
-            addr_result = await mask_pii(from_address)
-            result["from_address"] = addr_result["masked_text"]
-            result["total_entities_found"] += addr_result["entities_found"]
-            result["total_entities_masked"] += addr_result["entities_masked"]
+        result["subject"], result["body"], result["from_name"], result["from_address"] = parts
+        for field_result in field_results:
+            result["total_entities_found"] += field_result["entities_found"]
+            result["total_entities_masked"] += field_result["entities_masked"]
         
         result["success"] = True
         
@@ -291,6 +410,11 @@ def set_score_threshold(threshold: float):
     PRESIDIO_CONFIG["score_threshold"] = threshold
 
 
+def set_presidio_mode(mode: str):
+    """Set the masking mode: "regex" (local patterns only) or "nlp" (also Presidio)."""
+    PRESIDIO_CONFIG["mode"] = mode
+
+
 def get_presidio_config() -> dict:
     """Get current Presidio configuration."""
     return PRESIDIO_CONFIG.copy()
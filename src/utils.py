@@ -2,6 +2,16 @@
 Common utility functions shared across modules.
 """
 import re
+from html import unescape
+
+# Tags plus the contents of <script>/<style> blocks, which are never readable
+# text. An unclosed block falls through to the plain tag alternative, so only
+# the tag itself is dropped and the text after it is kept.
+_RE_TAG = re.compile(r'<script.*?</script>|<style.*?</style>|<[^>]+>', re.I | re.S)
+_RE_ZW = re.compile(r'[\u200b-\u200f\u2028-\u202f\u205f-\u206f\ufeff]')
+_RE_WS = re.compile(r'\s+')
+# Message ID segment of a Graph notification resource path
+_RE_MESSAGE_ID = re.compile(r'(?:^|/)messages/([^/]+)', re.I)
 
 
 def strip_html(html: str) -> str:
@@ -11,19 +21,25 @@ def strip_html(html: str) -> str:
     """
     if not html:
         return ""
-    # Remove HTML tags
-    text = re.sub(r'<[^>]+>', ' ', html)
-    # Replace &nbsp; and other common HTML entities
-    text = re.sub(r'&nbsp;', ' ', text)
-    text = re.sub(r'&#160;', ' ', text)  # numeric form of nbsp
-    text = re.sub(r'&amp;', '&', text)
-    text = re.sub(r'&lt;', '<', text)
-    text = re.sub(r'&gt;', '>', text)
-    text = re.sub(r'&quot;', '"', text)
-    text = re.sub(r'&#\d+;', '', text)  # remove other numeric entities
-    text = re.sub(r'&\w+;', '', text)  # remove any remaining named entities
-    # Remove zero-width characters and other invisible unicode
-    text = re.sub(r'[\u200b-\u200f\u2028-\u202f\u205f-\u206f\ufeff]', '', text)
+    # Remove HTML tags; plain-text bodies (what Graph returns) skip the pass
+    text = _RE_TAG.sub(' ', html) if '<' in html else html
+    # Decode entities (named and numeric)
+    if '&' in text:
+        text = unescape(text)
+    # Remove zero-width characters and other invisible unicode; they are all
+    # non-ASCII, so plain ASCII text (most email) skips this pass
+    if not text.isascii():
+        text = _RE_ZW.sub('', text)
     # Normalize whitespace
-    text = re.sub(r'\s+', ' ', text)
+    text = _RE_WS.sub(' ', text)
     return text.strip()
+
+
+def extract_message_id(resource: str) -> str | None:
+    """
+    Extract the message ID from a Graph notification resource path,
+    e.g. users/{email}/mailFolders/inbox/messages/{message-id}.
+    Returns None if the path has no messages/{id} segment.
+    """
+    match = _RE_MESSAGE_ID.search(resource or "")
+    return match.group(1) if match else None
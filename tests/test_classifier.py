@@ -16,7 +16,7 @@ def test_classification_prompt_structure():
     
     # Should contain all tag names
     for tag in CLASSIFICATION_TAGS:
-        assert tag["name"] in prompt
+        assert tag.name in prompt
     
     # Should contain JSON format instructions
     assert "classification" in prompt
@@ -39,7 +39,7 @@ def test_valid_classification_tags():
         "technical-proctoring", "technical-access",
         "general-inquiry", "complaint-escalation"
     }
-    actual_tags = {tag["name"] for tag in CLASSIFICATION_TAGS}
+    actual_tags = {tag.name for tag in CLASSIFICATION_TAGS}
     
     assert actual_tags == valid_tags
 
@@ -77,7 +77,7 @@ class TestClassifierResponseParsing:
         
         from config import CLASSIFICATION_TAGS
         
-        valid_tags = [tag["name"] for tag in CLASSIFICATION_TAGS]
+        valid_tags = [tag.name for tag in CLASSIFICATION_TAGS]
         
         # Simulate invalid tag
         result = {"classification": "invalid_tag", "confidence": 0.9, "reason": "test"}
@@ -157,3 +157,216 @@ class TestEmailExamples:
             "I have a question about the campus"
         )
         assert result == "general-inquiry"
+
+
+# =============================================================================
+# classify_emails_batch tests (js/pyodide mocked - only available in CF Workers)
+# =============================================================================
+
+def _import_classifier():
+    import sys
+    import os
+    sys.modules.setdefault('js', MagicMock())
+    sys.modules.setdefault('pyodide', MagicMock())
+    sys.modules.setdefault('pyodide.ffi', sys.modules['pyodide'].ffi)
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+    import classifier
+    classifier._RESULT_CACHE.clear()
+    return classifier
+
+
+def _gemini_response(text, usage=None):
+    """Build a fake fetch() Response carrying a Gemini JSON payload."""
+    data = {"candidates": [{"content": {"parts": [{"text": text}]}}]}
+    if usage:
+        data["usageMetadata"] = usage
+    response = MagicMock()
+    response.ok = True
+    response.text = AsyncMock(return_value=json.dumps(data))
+    return response
+
+
+@pytest.mark.asyncio
+async def test_classify_emails_batch_single_request():
+    """A batch is classified with one Gemini call and split in order."""
+    classifier = _import_classifier()
+    text = json.dumps([
+        {"classification": "finance-fees", "confidence": 0.9, "reason": "fees"},
+        {"classification": "registration", "confidence": 0.8, "reason": "register"},
+    ])
+    usage = {"promptTokenCount": 100, "candidatesTokenCount": 20, "totalTokenCount": 120}
+    post = AsyncMock(return_value=_gemini_response(text, usage))
+
+    with patch.object(classifier, "_post_gemini", post):
+        results = await classifier.classify_emails_batch("key", [
+            {"subject": "Fees", "body": "How much do I owe?"},
+            {"subject": "Register", "body": "<p>How do I register?</p>"},
+        ])
+
+    assert post.await_count == 1
+    assert [r["classification"] for r in results] == ["finance-fees", "registration"]
+    assert results[0]["token_usage"] == {"input_tokens": 50, "output_tokens": 10, "total_tokens": 60}
+
+
+@pytest.mark.asyncio
+async def test_classify_emails_batch_token_usage_adds_up():
+    """Per-email token usage sums to the batch total, with a separate dict per email."""
+    classifier = _import_classifier()
+    text = json.dumps([
+        {"classification": "finance-fees", "confidence": 0.9, "reason": "fees"},
+    ] * 3)
+    usage = {"promptTokenCount": 100, "candidatesTokenCount": 20, "totalTokenCount": 121}
+    post = AsyncMock(return_value=_gemini_response(text, usage))
+
+    with patch.object(classifier, "_post_gemini", post):
+        results = await classifier.classify_emails_batch("key", [
+            {"subject": f"Fees {i}", "body": f"Question {i}"} for i in range(3)
+        ])
+
+    usages = [r["token_usage"] for r in results]
+    assert {key: sum(u[key] for u in usages) for key in usages[0]} == {
+        "input_tokens": 100, "output_tokens": 20, "total_tokens": 121}
+    assert usages[0] is not usages[1]
+
+
+@pytest.mark.asyncio
+async def test_classify_emails_batch_falls_back_on_length_mismatch():
+    """A batch response with the wrong number of results is retried per email."""
+    classifier = _import_classifier()
+    text = json.dumps([{"classification": "finance-fees", "confidence": 0.9, "reason": "fees"}])
+    single = AsyncMock(return_value={
+        "classification": "general-inquiry", "confidence": 0.5, "reason": "x", "token_usage": None,
+    })
+
+    with patch.object(classifier, "_post_gemini", AsyncMock(return_value=_gemini_response(text))), \
+            patch.object(classifier, "_classify_clean", single):
+        results = await classifier.classify_emails_batch("key", [
+            {"subject": "A", "body": "a"},
+            {"subject": "B", "body": "b"},
+        ])
+
+    assert single.await_count == 2
+    assert len(results) == 2
+
+
+@pytest.mark.asyncio
+async def test_classify_emails_batch_http_failure_does_not_fan_out():
+    """A failed batch request gives failed results instead of one request per email."""
+    classifier = _import_classifier()
+    failed = MagicMock()
+    failed.ok = False
+    failed.status = 429
+    failed.text = AsyncMock(return_value="rate limited")
+    post = AsyncMock(return_value=failed)
+
+    with patch.object(classifier, "_post_gemini", post):
+        results = await classifier.classify_emails_batch("key", [
+            {"subject": "A", "body": "a"},
+            {"subject": "B", "body": "b"},
+        ])
+
+    assert post.await_count == 1
+    assert [r["confidence"] for r in results] == [0.0, 0.0]
+    assert classifier._RESULT_CACHE == {}
+
+
+@pytest.mark.asyncio
+async def test_classify_email_keyword_rule_skips_gemini():
+    """An unambiguous keyword match is classified without calling Gemini."""
+    classifier = _import_classifier()
+    post = AsyncMock()
+
+    with patch.object(classifier, "_post_gemini", post):
+        result = await classifier.classify_email("key", "Transcript", "<p>Please send me my official transcript</p>")
+
+    post.assert_not_awaited()
+    assert result["classification"] == "admin-transcript"
+    assert result["token_usage"] is None
+
+
+@pytest.mark.parametrize("result, reason", [
+    ({"classification": "finance-fees"}, "No reason provided"),
+    ({"classification": "made-up"}, "Invalid tag corrected to general. Original: N/A"),
+    ({"classification": "made-up", "reason": "fees"}, "Invalid tag corrected to general. Original: fees"),
+], ids=["valid-no-reason", "invalid-no-reason", "invalid-with-reason"])
+def test_validate_result_reason_fallbacks(result, reason):
+    """Missing reasons fall back to the same text as before the validator was rewritten."""
+    classifier = _import_classifier()
+    assert classifier._validate_result(result, None)["reason"] == reason
+
+
+@pytest.mark.parametrize("subject, body", [
+    ("RE: Official transcript", "I am still waiting and want to escalate this"),
+    ("Still waiting", "Please escalate. From: Student Sent: Monday To: Support Subject: transcript"),
+    ("Still waiting", "Please escalate. On Mon, 1 Jan 2024 Student wrote: I need my transcript"),
+], ids=["reply-subject", "outlook-quote", "gmail-quote"])
+def test_match_rule_ignores_thread_history(subject, body):
+    """Keyword rules only look at the newest message, not the quoted thread or carried subject."""
+    classifier = _import_classifier()
+    assert classifier._match_rule(subject, body) is None
+
+
+@pytest.mark.parametrize("subject, body", [
+    ("Transcript on hold", "My transcript is on hold because of outstanding fees"),
+    ("Missing marks", "The transcript of marks is missing my second semester results"),
+], ids=["fees-hold", "missing-marks"])
+def test_match_rule_leaves_ambiguous_transcript_mentions_to_gemini(subject, body):
+    """Mentioning a transcript without requesting one is not enough for the keyword rule."""
+    classifier = _import_classifier()
+    assert classifier._match_rule(subject, body) is None
+
+
+def test_match_rule_matches_newest_message():
+    """A keyword in the new text above the quote still matches."""
+    classifier = _import_classifier()
+    result = classifier._match_rule("RE: Query", "Please send my transcript. From: Support Sent: Monday")
+    assert result["classification"] == "admin-transcript"
+
+
+@pytest.mark.asyncio
+async def test_post_gemini_retries_transient_errors():
+    """429/5xx responses are retried and the first good response returned."""
+    classifier = _import_classifier()
+    busy = MagicMock()
+    busy.status = 503
+    busy.headers.get = MagicMock(return_value=None)
+    ok = MagicMock()
+    ok.status = 200
+    fetch = AsyncMock(side_effect=[busy, ok])
+
+    with patch.object(classifier, "fetch", fetch), \
+            patch.object(classifier.asyncio, "sleep", AsyncMock()) as sleep:
+        response = await classifier._post_gemini("key", {"contents": []})
+
+    assert response is ok
+    assert fetch.await_count == 2
+    sleep.assert_awaited_once()
+
+
+@pytest.mark.parametrize("text", [
+    '{"classification": "finance-fees", "confidence": 0.8, "reason": "fees"}',
+    '```json\n{"classification": "finance-fees", "confidence": 0.8, "reason": "fees"}\n```',
+    'Here you go: {"classification": "finance-fees", "confidence": 0.8, "reason": "fees"} thanks',
+])
+def test_extract_json_handles_wrappers(text):
+    """JSON is found whether bare, fenced, or wrapped in prose."""
+    classifier = _import_classifier()
+    assert json.loads(classifier._extract_json(text))["classification"] == "finance-fees"
+
+
+@pytest.mark.asyncio
+async def test_classify_email_caches_duplicate_content():
+    """A repeated email is answered from the cache without a second Gemini call."""
+    classifier = _import_classifier()
+    text = json.dumps({"classification": "finance-fees", "confidence": 0.9, "reason": "fees"})
+    usage = {"promptTokenCount": 100, "candidatesTokenCount": 20, "totalTokenCount": 120}
+    post = AsyncMock(side_effect=lambda *a: _gemini_response(text, usage))
+
+    with patch.object(classifier, "_post_gemini", post):
+        first = await classifier.classify_email("key", "Balance", "How much do I owe?")
+        second = await classifier.classify_email("key", "Balance", "How much do I owe?")
+
+    assert post.await_count == 1
+    assert first["token_usage"] is not None
+    assert second["classification"] == "finance-fees"
+    assert second["token_usage"] is None
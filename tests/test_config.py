@@ -4,12 +4,17 @@ import os
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
 
-from config import CLASSIFICATION_TAGS, get_classification_prompt
+from config import (
+    CLASSIFICATION_TAGS,
+    CLASSIFICATION_RULES,
+    get_classification_prompt,
+    _build_classification_prompt,
+)
 
 
 def test_classification_tags_exist():
     """Verify all expected tags are present."""
-    tag_names = [tag["name"] for tag in CLASSIFICATION_TAGS]
+    tag_names = [tag.name for tag in CLASSIFICATION_TAGS]
     expected = [
         "academic-results", "academic-exam", "academic-assignment",
         "admin-transcript", "admin-graduation",
@@ -23,17 +28,17 @@ def test_classification_tags_exist():
 def test_each_tag_has_required_fields():
     """Each tag must have name, description, and examples."""
     for tag in CLASSIFICATION_TAGS:
-        assert "name" in tag, f"Tag missing 'name'"
-        assert "description" in tag, f"Tag {tag.get('name')} missing 'description'"
-        assert "examples" in tag, f"Tag {tag.get('name')} missing 'examples'"
-        assert len(tag["examples"]) > 0, f"Tag {tag['name']} has no examples"
+        assert tag.name, f"Tag missing 'name'"
+        assert tag.description, f"Tag {tag.name} missing 'description'"
+        assert isinstance(tag.examples, tuple), f"Tag {tag.name} examples should be a tuple"
+        assert len(tag.examples) > 0, f"Tag {tag.name} has no examples"
 
 
 def test_get_classification_prompt_includes_all_tags():
     """The prompt should include all tag names."""
     prompt = get_classification_prompt()
     for tag in CLASSIFICATION_TAGS:
-        assert tag["name"] in prompt, f"Tag {tag['name']} not in prompt"
+        assert tag.name in prompt, f"Tag {tag.name} not in prompt"
 
 
 def test_get_classification_prompt_includes_json_format():
@@ -48,10 +53,24 @@ def test_get_classification_prompt_includes_json_format():
 def test_tag_names_are_lowercase():
     """Tag names should be lowercase for consistency."""
     for tag in CLASSIFICATION_TAGS:
-        assert tag["name"] == tag["name"].lower(), f"Tag {tag['name']} should be lowercase"
+        assert tag.name == tag.name.lower(), f"Tag {tag.name} should be lowercase"
 
 
 def test_tag_descriptions_not_empty():
     """Tag descriptions should be meaningful."""
     for tag in CLASSIFICATION_TAGS:
-        assert len(tag["description"]) > 20, f"Tag {tag['name']} has too short description"
+        assert len(tag.description) > 20, f"Tag {tag.name} has too short description"
+
+
+def test_classification_rules_use_valid_tags():
+    """Keyword rules must map to existing tags with a sane confidence."""
+    tag_names = {tag.name for tag in CLASSIFICATION_TAGS}
+    for pattern, tag, confidence in CLASSIFICATION_RULES:
+        assert tag in tag_names, f"Rule {pattern} uses unknown tag {tag}"
+        assert 0.0 < confidence <= 1.0, f"Rule {pattern} has invalid confidence"
+
+
+def test_get_classification_prompt_is_cached():
+    """The prompt is built once and matches a fresh build."""
+    assert get_classification_prompt() is get_classification_prompt()
+    assert get_classification_prompt() == _build_classification_prompt()
@@ -1,7 +1,12 @@
 """Tests for database operations (mock-based)."""
 import sys
 import os
-from unittest.mock import MagicMock
+import gc
+import itertools
+import sqlite3
+from dataclasses import dataclass, replace
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
 
 # Mock the js module before importing database (only available in CF Workers runtime)
 mock_console = MagicMock()
@@ -15,14 +20,26 @@ mock_json.stringify = MagicMock(return_value='{"test": true}')
 sys.modules['js'] = MagicMock()
 sys.modules['js'].console = mock_console
 sys.modules['js'].JSON = mock_json
+sys.modules.setdefault('pyodide', MagicMock())
+sys.modules.setdefault('pyodide.ffi', sys.modules['pyodide'].ffi)
 
 # Add src to path for imports
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
 
 import pytest
+import database
 from database import (
+    SCHEMA_STATEMENTS,
+    init_db,
     email_exists,
+    emails_existing,
     save_email,
+    save_emails,
+    save_email_with_usage,
+    save_llm_usage,
+    _EMAIL_FIELDS,
+    _RECENT_FIELDS,
+    _CONVERSATION_FIELDS,
     get_email_by_message_id,
     get_recent_emails,
     get_classification_stats,
@@ -31,73 +48,139 @@ from database import (
 )
 
 
+@dataclass(frozen=True, slots=True)
+class EmailRow:
+    """An emails row; columns a test does not set are NULL."""
+    id: int | None = None
+    message_id: str | None = None
+    conversation_id: str | None = None
+    subject: str | None = None
+    snippet: str | None = None
+    from_address: str | None = None
+    from_name: str | None = None
+    classification: str | None = None
+    confidence: float | None = None
+    reason: str | None = None
+    draft_reply: str | None = None
+    received_at: str | None = None
+    processed_at: str | None = None
+
+
+# Template for the email fixtures; tests derive rows with replace()
+_BASE_EMAIL = EmailRow(
+    id=1,
+    message_id="msg-1",
+    conversation_id="conv-abc",
+    subject="Initial question",
+    snippet="I have a question...",
+    from_address="student@example.com",
+    from_name="Student",
+    classification="academic-results",
+    confidence=0.9,
+    received_at="2024-01-01T10:00:00Z",
+)
+
+
+def _raw_rows(rows, fields):
+    """Convert attribute-style rows to the positional lists .raw() returns."""
+    return [[getattr(row, field) for field in fields] for row in rows]
+
+
 class MockDB:
     """Mock D1 database for testing."""
     
-    def __init__(self):
+    def __init__(self, js_id=1):
+        # Identifies the underlying JS binding; proxies of one binding share it
+        self.js_id = js_id
+        self.reset()
+    
+    def reset(self):
+        """Clear recorded state and any per-test prepare override."""
+        self.__dict__.pop("prepare", None)
         self.data = {}
+        self.bound_ids = []
+        self.inserted = []
+        self.usage_rows = []
+        self.batches = 0
         self._last_id = 0
     
     async def exec(self, query):
         return MagicMock()
     
+    async def batch(self, statements):
+        self.batches += 1
+        return [await statement.run() for statement in statements]
+    
     def prepare(self, query):
         mock = MagicMock()
         mock.bind = MagicMock(return_value=mock)
         
         # email_exists query
-        if "SELECT 1 FROM emails WHERE message_id" in query:
+        if "SELECT 1 AS x FROM emails WHERE message_id" in query:
             async def first():
                 return self.data.get("exists_check")
             mock.first = first
         
+        # emails_existing query
+        elif "SELECT message_id FROM emails WHERE message_id IN" in query:
+            def bind(*ids):
+                self.bound_ids.append(ids)
+                return mock
+            mock.bind = bind
+            async def all():
+                result = MagicMock()
+                result.results = [
+                    row for row in self.data.get("existing_rows", [])
+                    if row.message_id in self.bound_ids[-1]
+                ]
+                return result
+            mock.all = all
+        
         # save_email query
         elif "INSERT INTO emails" in query:
+            def bind(*values):
+                self.inserted.append(values)
+                return mock
+            mock.bind = bind
             async def run():
                 self._last_id += 1
                 result = MagicMock()
-                result.meta = MagicMock()
-                result.meta.last_row_id = self._last_id
+                result.results = [MagicMock(id=self._last_id)]
                 return result
             mock.run = run
         
         # get_email_by_message_id query
-        elif "SELECT * FROM emails WHERE message_id" in query:
-            async def first():
-                return self.data.get("email")
-            mock.first = first
+        elif "FROM emails WHERE message_id = ? LIMIT 1" in query:
+            async def raw():
+                email = self.data.get("email")
+                return _raw_rows([email] if email else [], _EMAIL_FIELDS)
+            mock.raw = raw
         
         # get_emails_by_conversation query
-        elif "SELECT * FROM emails WHERE conversation_id" in query:
-            async def all():
-                result = MagicMock()
-                result.results = self.data.get("conversation_emails", [])
-                return result
-            mock.all = all
+        elif "FROM emails WHERE conversation_id = ?" in query:
+            async def raw():
+                return _raw_rows(self.data.get("conversation_emails", []), _CONVERSATION_FIELDS)
+            mock.raw = raw
         
         # get_recent_emails query
-        elif "SELECT * FROM emails ORDER BY" in query:
-            async def all():
-                result = MagicMock()
-                result.results = self.data.get("recent_emails", [])
-                return result
-            mock.all = all
+        elif "FROM emails ORDER BY processed_at" in query:
+            async def raw():
+                return _raw_rows(self.data.get("recent_emails", []), _RECENT_FIELDS)
+            mock.raw = raw
         
-        # get_classification_stats query
-        elif "SELECT classification, COUNT" in query:
-            async def all():
-                result = MagicMock()
-                result.results = self.data.get("classification_stats", [])
-                return result
-            mock.all = all
-        
-        # get_conversation_stats query
-        elif "GROUP BY conversation_id" in query:
-            async def all():
-                result = MagicMock()
-                result.results = self.data.get("conversation_stats", [])
-                return result
-            mock.all = all
+        # save_llm_usage query
+        elif "INSERT INTO llm_usage" in query:
+            def bind(*values):
+                self.usage_rows.append(values)
+                return mock
+            mock.bind = bind
+            async def first():
+                self._last_id += 1
+                return MagicMock(id=self._last_id)
+            mock.first = first
+            async def run():
+                return MagicMock()
+            mock.run = run
         
         # Default fallback
         else:
@@ -113,16 +196,123 @@ class MockDB:
         return mock
 
 
-@pytest.fixture
-def mock_db():
+# js_id values for SqliteD1; kept apart from MockDB's so cached statements never cross
+_SQLITE_JS_IDS = itertools.count(1000)
+
+
+class SqliteD1:
+    """D1 stand-in backed by in-memory sqlite3, for queries whose SQL does the work."""
+    
+    def __init__(self, rows=()):
+        self.js_id = next(_SQLITE_JS_IDS)
+        self.conn = sqlite3.connect(":memory:")
+        self.conn.row_factory = sqlite3.Row
+        for sql in SCHEMA_STATEMENTS:
+            self.conn.execute(sql)
+        self.conn.executemany(
+            "INSERT INTO emails (message_id, conversation_id, classification) VALUES (?, ?, ?)",
+            [(row.message_id, row.conversation_id, row.classification) for row in rows],
+        )
+    
+    def prepare(self, query):
+        return _SqliteStatement(self.conn, query)
+
+
+class _SqliteStatement:
+    def __init__(self, conn, query, params=()):
+        self.conn = conn
+        self.query = query
+        self.params = params
+    
+    def bind(self, *params):
+        return _SqliteStatement(self.conn, self.query, params)
+    
+    async def first(self):
+        row = self.conn.execute(self.query, self.params).fetchone()
+        return SimpleNamespace(**dict(row)) if row else None
+
+
+def _classified(message_id, conversation_id, classification):
+    return replace(_BASE_EMAIL, message_id=message_id, conversation_id=conversation_id,
+                   classification=classification)
+
+
+@pytest.fixture(scope="module", autouse=True)
+def _python_ffi():
+    """Plain-Python to_js/jsnull in database, for this module only (the shared pyodide stub is left alone)."""
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(database, "to_js", lambda obj, **kwargs: obj)
+        mp.setattr(database, "jsnull", None)
+        yield
+
+
+@pytest.fixture(scope="module", autouse=True)
+def _no_gc():
+    """Keep the cyclic collector out of the MagicMock-heavy tests; collect once after."""
+    gc.collect()
+    gc.disable()
+    yield
+    gc.enable()
+    gc.collect()
+
+
+@pytest.fixture(scope="session")
+def _mock_db_singleton():
     return MockDB()
 
 
+@pytest.fixture
+def mock_db(_mock_db_singleton):
+    """The shared MockDB, reset so each test starts from a fresh binding."""
+    _mock_db_singleton.reset()
+    # database caches prepared statements per binding
+    database._STMTS.clear()
+    return _mock_db_singleton
+
+
+# =============================================================================
+# init_db tests
+# =============================================================================
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_init_db_applies_schema_in_one_batch(mock_db):
+    """Test init_db sends every DDL statement in a single batch."""
+    prepared = []
+    mock_db.prepare = lambda query: prepared.append(query) or MagicMock(run=AsyncMock())
+    
+    await init_db(mock_db)
+    
+    assert mock_db.batches == 1
+    assert prepared == list(SCHEMA_STATEMENTS)
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_init_db_reapplies_schema_every_call(mock_db):
+    """Test repeated init_db calls re-run the DDL, so schema changes are applied."""
+    mock_db.prepare = lambda query: MagicMock(run=AsyncMock())
+    
+    await init_db(mock_db)
+    await init_db(mock_db)
+    
+    assert mock_db.batches == 2
+
+
+def test_schema_statements_are_idempotent():
+    """Test the schema DDL is valid SQLite and can be re-applied."""
+    conn = sqlite3.connect(":memory:")
+    for _ in range(2):
+        for sql in SCHEMA_STATEMENTS:
+            conn.execute(sql)
+    indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert "idx_emails_conv_received" in indexes
+    assert "idx_emails_message_id" not in indexes
+
+
 # =============================================================================
 # email_exists tests
 # =============================================================================
 
-@pytest.mark.asyncio
+@pytest.mark.asyncio(loop_scope="module")
 async def test_email_exists_returns_false_when_not_found(mock_db):
     """Test email_exists returns False when email not in DB."""
     mock_db.data["exists_check"] = None
@@ -130,7 +320,7 @@ async def test_email_exists_returns_false_when_not_found(mock_db):
     assert result is False
 
 
-@pytest.mark.asyncio
+@pytest.mark.asyncio(loop_scope="module")
 async def test_email_exists_returns_true_when_found(mock_db):
     """Test email_exists returns True when email exists."""
     mock_db.data["exists_check"] = {"id": 1}
@@ -138,11 +328,88 @@ async def test_email_exists_returns_true_when_found(mock_db):
     assert result is True
 
 
+@pytest.mark.asyncio(loop_scope="module")
+async def test_email_exists_returns_false_for_empty_proxy(mock_db, monkeypatch):
+    """Test an empty first() proxy is not treated as an existing row, even though it is truthy."""
+    empty_proxy = MagicMock()  # truthy, like a real JsProxy of {}
+    assert empty_proxy
+    mock_db.data["exists_check"] = empty_proxy
+    monkeypatch.setattr(database.JSON, "stringify", MagicMock(return_value="{}"))
+    
+    result = await email_exists(mock_db, "msg-missing")
+    assert result is False
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_email_exists_reuses_prepared_statement(mock_db):
+    """Test repeated checks on the same binding prepare the SQL once."""
+    prepared = []
+    prepare = mock_db.prepare
+    mock_db.prepare = lambda query: prepared.append(query) or prepare(query)
+    mock_db.data["exists_check"] = None
+    
+    await email_exists(mock_db, "msg-1")
+    await email_exists(mock_db, "msg-2")
+    
+    assert len(prepared) == 1
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_prepared_statements_follow_the_js_binding(mock_db):
+    """Test a new proxy of the same binding reuses statements; another binding re-prepares."""
+    await email_exists(mock_db, "msg-1")
+    
+    same_binding = MockDB(js_id=mock_db.js_id)
+    same_binding.prepare = MagicMock(side_effect=AssertionError("re-prepared"))
+    await email_exists(same_binding, "msg-2")
+    
+    other_binding = MockDB(js_id=mock_db.js_id + 1)
+    other_binding.prepare = MagicMock(wraps=other_binding.prepare)
+    await email_exists(other_binding, "msg-3")
+    other_binding.prepare.assert_called_once()
+
+
+# =============================================================================
+# emails_existing tests
+# =============================================================================
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_emails_existing_returns_seen_ids(mock_db):
+    """Test emails_existing returns only the IDs already stored."""
+    row = EmailRow(message_id="msg-2")
+    mock_db.data["existing_rows"] = [row]
+    
+    result = await emails_existing(mock_db, ["msg-1", "msg-2", "msg-3"])
+    
+    assert result == {"msg-2"}
+    assert len(mock_db.bound_ids) == 1
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_emails_existing_chunks_large_batches(mock_db):
+    """Test emails_existing splits large ID lists into chunks."""
+    ids = [f"msg-{i}" for i in range(250)]
+    
+    result = await emails_existing(mock_db, ids)
+    
+    assert result == set()
+    assert [len(chunk) for chunk in mock_db.bound_ids] == [100, 100, 50]
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_emails_existing_empty_input(mock_db):
+    """Test emails_existing makes no queries for an empty list."""
+    result = await emails_existing(mock_db, [])
+    
+    assert result == set()
+    assert mock_db.bound_ids == []
+
+
 # =============================================================================
 # save_email tests
 # =============================================================================
 
-@pytest.mark.asyncio
+@pytest.mark.asyncio(loop_scope="module")
 async def test_save_email_returns_id(mock_db):
     """Test save_email returns the new row ID."""
     result = await save_email(
@@ -160,7 +427,7 @@ async def test_save_email_returns_id(mock_db):
     assert result == 1
 
 
-@pytest.mark.asyncio
+@pytest.mark.asyncio(loop_scope="module")
 async def test_save_email_with_conversation_id(mock_db):
     """Test save_email stores conversation_id correctly."""
     result = await save_email(
@@ -179,7 +446,7 @@ async def test_save_email_with_conversation_id(mock_db):
     assert result == 1
 
 
-@pytest.mark.asyncio
+@pytest.mark.asyncio(loop_scope="module")
 async def test_save_email_handles_none_values(mock_db):
     """Test save_email handles None values gracefully."""
     result = await save_email(
@@ -198,27 +465,91 @@ async def test_save_email_handles_none_values(mock_db):
     assert result == 1
 
 
+@pytest.mark.asyncio(loop_scope="module")
+async def test_save_emails_uses_single_batch(mock_db):
+    """Test save_emails writes all records in one D1 batch."""
+    records = [
+        {
+            "message_id": f"msg-{i}",
+            "subject": None if i == 1 else f"Subject {i}",
+            "classification": "general",
+            "confidence": 0.8,
+        }
+        for i in range(3)
+    ]
+    
+    result = await save_emails(mock_db, records)
+    
+    assert result == [1, 2, 3]
+    assert mock_db.batches == 1
+    assert [values[0] for values in mock_db.inserted] == ["msg-0", "msg-1", "msg-2"]
+    assert mock_db.inserted[1][2] is None
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_save_emails_empty_input(mock_db):
+    """Test save_emails skips the batch for an empty list."""
+    assert await save_emails(mock_db, []) == []
+    assert mock_db.batches == 0
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_save_llm_usage_returns_id(mock_db):
+    """Test save_llm_usage returns the id from the RETURNING row."""
+    result = await save_llm_usage(mock_db, 1, "gemini", "classification", 100, 20, 120)
+    assert result == 1
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_save_email_with_usage_single_batch(mock_db):
+    """Test the email row and its usage row are written in one batch."""
+    usage = {
+        "model": "gemini",
+        "operation": "classification",
+        "input_tokens": 100,
+        "output_tokens": 20,
+        "total_tokens": 120,
+    }
+    result = await save_email_with_usage(
+        mock_db,
+        {"message_id": "msg-1", "classification": "general", "confidence": 0.8},
+        usage,
+    )
+    
+    assert result == 1
+    assert mock_db.batches == 1
+    assert mock_db.usage_rows == [("msg-1", "gemini", "classification", 100, 20, 120)]
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_save_email_with_usage_without_usage(mock_db):
+    """Test no usage row is written when there is no token usage."""
+    result = await save_email_with_usage(
+        mock_db,
+        {"message_id": "msg-1", "classification": "general", "confidence": 0.8},
+    )
+    
+    assert result == 1
+    assert mock_db.usage_rows == []
+
+
 # =============================================================================
 # get_email_by_message_id tests
 # =============================================================================
 
-@pytest.mark.asyncio
+@pytest.mark.asyncio(loop_scope="module")
 async def test_get_email_by_message_id_returns_email(mock_db):
     """Test get_email_by_message_id returns full email data."""
-    mock_email = MagicMock()
-    mock_email.id = 1
-    mock_email.message_id = "test-123"
-    mock_email.conversation_id = "conv-456"
-    mock_email.subject = "Test Subject"
-    mock_email.snippet = "Test snippet"
-    mock_email.from_address = "test@example.com"
-    mock_email.from_name = "Test User"
-    mock_email.classification = "finance-payment"
-    mock_email.confidence = 0.95
-    mock_email.reason = "Payment related"
-    mock_email.draft_reply = ""
-    mock_email.received_at = "2024-01-01"
-    mock_email.processed_at = "2024-01-01"
+    mock_email = replace(
+        _BASE_EMAIL,
+        message_id="test-123",
+        conversation_id="conv-456",
+        subject="Test Subject",
+        classification="finance-payment",
+        reason="Payment related",
+        draft_reply="",
+        processed_at="2024-01-01",
+    )
     
     mock_db.data["email"] = mock_email
     
@@ -231,7 +562,7 @@ async def test_get_email_by_message_id_returns_email(mock_db):
     assert result["classification"] == "finance-payment"
 
 
-@pytest.mark.asyncio
+@pytest.mark.asyncio(loop_scope="module")
 async def test_get_email_by_message_id_returns_none_when_not_found(mock_db):
     """Test get_email_by_message_id returns None when email not found."""
     mock_db.data["email"] = None
@@ -244,144 +575,82 @@ async def test_get_email_by_message_id_returns_none_when_not_found(mock_db):
 # get_recent_emails tests
 # =============================================================================
 
-@pytest.mark.asyncio
-async def test_get_recent_emails_returns_list(mock_db):
-    """Test get_recent_emails returns list of emails."""
-    mock_email = MagicMock()
-    mock_email.id = 1
-    mock_email.message_id = "test-123"
-    mock_email.conversation_id = "conv-123"
-    mock_email.subject = "Test"
-    mock_email.classification = "academic-results"
-    mock_email.confidence = 0.9
-    mock_email.received_at = "2024-01-01"
-    
-    mock_db.data["recent_emails"] = [mock_email]
-    
-    result = await get_recent_emails(mock_db, 10)
-    
-    assert len(result) == 1
-    assert result[0]["message_id"] == "test-123"
-    assert result[0]["conversation_id"] == "conv-123"
-    assert result[0]["classification"] == "academic-results"
-
-
-@pytest.mark.asyncio
-async def test_get_recent_emails_returns_empty_list(mock_db):
-    """Test get_recent_emails returns empty list when no emails."""
-    mock_db.data["recent_emails"] = []
-    
-    result = await get_recent_emails(mock_db, 10)
-    assert result == []
+_RECENT_ROW_1 = replace(_BASE_EMAIL, conversation_id="conv-1", classification="finance-fees")
+_RECENT_ROW_2 = replace(_BASE_EMAIL, id=2, message_id="msg-2", conversation_id="conv-2")
 
 
-@pytest.mark.asyncio
-async def test_get_recent_emails_returns_multiple(mock_db):
-    """Test get_recent_emails returns multiple emails."""
-    mock_email1 = MagicMock()
-    mock_email1.id = 1
-    mock_email1.message_id = "msg-1"
-    mock_email1.conversation_id = "conv-1"
-    mock_email1.subject = "First"
-    mock_email1.classification = "finance-fees"
-    mock_email1.confidence = 0.9
-    mock_email1.received_at = "2024-01-01"
-    
-    mock_email2 = MagicMock()
-    mock_email2.id = 2
-    mock_email2.message_id = "msg-2"
-    mock_email2.conversation_id = "conv-1"
-    mock_email2.subject = "Second"
-    mock_email2.classification = "finance-fees"
-    mock_email2.confidence = 0.85
-    mock_email2.received_at = "2024-01-02"
-    
-    mock_db.data["recent_emails"] = [mock_email1, mock_email2]
+@pytest.mark.asyncio(loop_scope="module")
+@pytest.mark.parametrize("rows", [
+    [],
+    [_RECENT_ROW_1],
+    [_RECENT_ROW_1, _RECENT_ROW_2],
+], ids=["empty", "single", "multiple"])
+async def test_get_recent_emails(mock_db, rows):
+    """Test get_recent_emails returns one dict per row, in order."""
+    mock_db.data["recent_emails"] = rows
     
     result = await get_recent_emails(mock_db, 10)
     
-    assert len(result) == 2
-    assert result[0]["message_id"] == "msg-1"
-    assert result[1]["message_id"] == "msg-2"
+    assert [
+        (email["message_id"], email["conversation_id"], email["classification"])
+        for email in result
+    ] == [(row.message_id, row.conversation_id, row.classification) for row in rows]
 
 
 # =============================================================================
 # get_classification_stats tests
 # =============================================================================
 
-@pytest.mark.asyncio
-async def test_get_classification_stats_returns_dict(mock_db):
-    """Test get_classification_stats returns stats dictionary."""
-    mock_stat = MagicMock()
-    mock_stat.classification = "academic-results"
-    mock_stat.count = 5
-    
-    mock_db.data["classification_stats"] = [mock_stat]
-    
-    result = await get_classification_stats(mock_db)
-    assert result["academic-results"] == 5
-
-
-@pytest.mark.asyncio
-async def test_get_classification_stats_multiple_categories(mock_db):
-    """Test get_classification_stats with multiple categories."""
-    mock_stats = []
-    for cat, count in [("academic-results", 10), ("finance-payment", 5), ("registration", 3)]:
-        stat = MagicMock()
-        stat.classification = cat
-        stat.count = count
-        mock_stats.append(stat)
-    
-    mock_db.data["classification_stats"] = mock_stats
-    
-    result = await get_classification_stats(mock_db)
-    
-    assert result["academic-results"] == 10
-    assert result["finance-payment"] == 5
-    assert result["registration"] == 3
+_CLASSIFICATION_STATS_MULTI = (
+    *(_classified(f"msg-r{i}", "conv-1", "academic-results") for i in range(3)),
+    *(_classified(f"msg-p{i}", "conv-2", "finance-payment") for i in range(2)),
+    _classified("msg-g1", "conv-3", "registration"),
+    _classified("msg-n1", "conv-3", None),
+)
 
 
-@pytest.mark.asyncio
-async def test_get_classification_stats_empty(mock_db):
-    """Test get_classification_stats returns empty dict when no data."""
-    mock_db.data["classification_stats"] = []
-    
-    result = await get_classification_stats(mock_db)
-    assert result == {}
+@pytest.mark.asyncio(loop_scope="module")
+@pytest.mark.parametrize("rows, expected", [
+    ((_classified("msg-1", "conv-1", "academic-results"),), {"academic-results": 1}),
+    (_CLASSIFICATION_STATS_MULTI, {"academic-results": 3, "finance-payment": 2, "registration": 1}),
+    ((_classified("msg-1", "conv-1", None),), {}),
+    ((), {}),
+], ids=["single", "multiple-categories", "unclassified-only", "empty"])
+async def test_get_classification_stats(rows, expected):
+    """Test SQL_CLASSIFICATION_STATS counts each classification, skipping NULLs."""
+    result = await get_classification_stats(SqliteD1(rows))
+    assert result == expected
 
 
 # =============================================================================
 # get_emails_by_conversation tests
 # =============================================================================
 
-@pytest.mark.asyncio
-async def test_get_emails_by_conversation_returns_thread(mock_db):
+# Overrides of _BASE_EMAIL for each message in the thread
+_THREAD_ROWS = [
+    {},
+    {
+        "id": 2,
+        "message_id": "msg-2",
+        "subject": "Re: Initial question",
+        "snippet": "Following up...",
+        "confidence": 0.85,
+        "received_at": "2024-01-02T10:00:00Z",
+    },
+]
+
+
+@pytest.fixture
+def conversation_thread(request):
+    """EmailRows built from the parametrized overrides when the test runs, not at collection."""
+    return [replace(_BASE_EMAIL, **row) for row in request.param]
+
+
+@pytest.mark.asyncio(loop_scope="module")
+@pytest.mark.parametrize("conversation_thread", [_THREAD_ROWS], indirect=True, ids=["two-messages"])
+async def test_get_emails_by_conversation_returns_thread(mock_db, conversation_thread):
     """Test get_emails_by_conversation returns all emails in a thread."""
-    mock_email1 = MagicMock()
-    mock_email1.id = 1
-    mock_email1.message_id = "msg-1"
-    mock_email1.conversation_id = "conv-abc"
-    mock_email1.subject = "Initial question"
-    mock_email1.snippet = "I have a question..."
-    mock_email1.from_address = "student@example.com"
-    mock_email1.from_name = "Student"
-    mock_email1.classification = "academic-results"
-    mock_email1.confidence = 0.9
-    mock_email1.received_at = "2024-01-01T10:00:00Z"
-    
-    mock_email2 = MagicMock()
-    mock_email2.id = 2
-    mock_email2.message_id = "msg-2"
-    mock_email2.conversation_id = "conv-abc"
-    mock_email2.subject = "Re: Initial question"
-    mock_email2.snippet = "Following up..."
-    mock_email2.from_address = "student@example.com"
-    mock_email2.from_name = "Student"
-    mock_email2.classification = "academic-results"
-    mock_email2.confidence = 0.85
-    mock_email2.received_at = "2024-01-02T10:00:00Z"
-    
-    mock_db.data["conversation_emails"] = [mock_email1, mock_email2]
+    mock_db.data["conversation_emails"] = conversation_thread
     
     result = await get_emails_by_conversation(mock_db, "conv-abc")
     
@@ -392,7 +661,7 @@ async def test_get_emails_by_conversation_returns_thread(mock_db):
     assert result[1]["subject"] == "Re: Initial question"
 
 
-@pytest.mark.asyncio
+@pytest.mark.asyncio(loop_scope="module")
 async def test_get_emails_by_conversation_returns_empty(mock_db):
     """Test get_emails_by_conversation returns empty list for unknown conversation."""
     mock_db.data["conversation_emails"] = []
@@ -401,110 +670,92 @@ async def test_get_emails_by_conversation_returns_empty(mock_db):
     assert result == []
 
 
-@pytest.mark.asyncio
+_EMAIL_KEYS = frozenset({
+    "id", "message_id", "conversation_id", "subject", "snippet",
+    "from_address", "from_name", "classification", "confidence", "received_at",
+})
+
+
+@pytest.mark.asyncio(loop_scope="module")
 async def test_get_emails_by_conversation_includes_all_fields(mock_db):
     """Test get_emails_by_conversation returns all expected fields."""
-    mock_email = MagicMock()
-    mock_email.id = 1
-    mock_email.message_id = "msg-1"
-    mock_email.conversation_id = "conv-123"
-    mock_email.subject = "Test"
-    mock_email.snippet = "Test snippet"
-    mock_email.from_address = "test@example.com"
-    mock_email.from_name = "Test User"
-    mock_email.classification = "registration"
-    mock_email.confidence = 0.88
-    mock_email.received_at = "2024-01-01"
-    
-    mock_db.data["conversation_emails"] = [mock_email]
-    
-    result = await get_emails_by_conversation(mock_db, "conv-123")
+    mock_db.data["conversation_emails"] = [_BASE_EMAIL]
+    
+    result = await get_emails_by_conversation(mock_db, "conv-abc")
     
     assert len(result) == 1
     email = result[0]
-    assert "id" in email
-    assert "message_id" in email
-    assert "conversation_id" in email
-    assert "subject" in email
-    assert "snippet" in email
-    assert "from_address" in email
-    assert "from_name" in email
-    assert "classification" in email
-    assert "confidence" in email
-    assert "received_at" in email
+    assert _EMAIL_KEYS <= email.keys(), _EMAIL_KEYS - email.keys()
 
 
 # =============================================================================
 # get_conversation_stats tests
 # =============================================================================
 
-@pytest.mark.asyncio
-async def test_get_conversation_stats_returns_stats(mock_db):
-    """Test get_conversation_stats returns conversation statistics."""
-    mock_stat = MagicMock()
-    mock_stat.conversation_id = "conv-123"
-    mock_stat.message_count = 3
-    mock_stat.classifications = "academic-results,academic-exam"
-    
-    mock_db.data["conversation_stats"] = [mock_stat]
-    
-    result = await get_conversation_stats(mock_db)
-    
-    assert result["total_conversations"] == 1
-    assert len(result["conversations"]) == 1
-    assert result["conversations"][0]["conversation_id"] == "conv-123"
-    assert result["conversations"][0]["message_count"] == 3
-    assert "academic-results" in result["conversations"][0]["classifications"]
-    assert "academic-exam" in result["conversations"][0]["classifications"]
+_CONV_STATS_MULTI = (
+    _classified("msg-1", "conv-small", "registration"),
+    _classified("msg-2", "conv-big", "finance-payment"),
+    _classified("msg-3", "conv-big", "finance-fees"),
+    _classified("msg-4", "conv-big", "finance-payment"),
+    _classified("msg-5", "conv-big", None),
+    _classified("msg-6", "conv-unclassified", None),
+    _classified("msg-7", "conv-unclassified", None),
+    # No conversation: left out of the stats
+    _classified("msg-8", None, "registration"),
+    _classified("msg-9", "", "registration"),
+)
 
 
-@pytest.mark.asyncio
-async def test_get_conversation_stats_empty(mock_db):
-    """Test get_conversation_stats returns empty when no conversations."""
-    mock_db.data["conversation_stats"] = []
-    
-    result = await get_conversation_stats(mock_db)
-    
-    assert result["total_conversations"] == 0
-    assert result["conversations"] == []
+@pytest.mark.asyncio(loop_scope="module")
+@pytest.mark.parametrize("rows, expected", [
+    (
+        _CONV_STATS_MULTI,
+        [
+            {"conversation_id": "conv-big", "message_count": 4,
+             "classifications": ["finance-fees", "finance-payment"]},
+            {"conversation_id": "conv-unclassified", "message_count": 2, "classifications": []},
+            {"conversation_id": "conv-small", "message_count": 1, "classifications": ["registration"]},
+        ],
+    ),
+    ((), []),
+], ids=["ordered-distinct", "empty"])
+async def test_get_conversation_stats(rows, expected):
+    """Test SQL_CONVERSATION_STATS orders by size, de-duplicates and skips NULL classifications."""
+    result = await get_conversation_stats(SqliteD1(rows))
+    
+    # SQLite does not define the order of json_group_array(DISTINCT ...)
+    for conversation in result["conversations"]:
+        conversation["classifications"].sort()
+    assert result == {"total_conversations": len(expected), "conversations": expected}
 
 
-@pytest.mark.asyncio
-async def test_get_conversation_stats_multiple_conversations(mock_db):
-    """Test get_conversation_stats with multiple conversations."""
-    mock_stats = []
-    
-    stat1 = MagicMock()
-    stat1.conversation_id = "conv-1"
-    stat1.message_count = 5
-    stat1.classifications = "finance-payment,finance-fees"
-    mock_stats.append(stat1)
-    
-    stat2 = MagicMock()
-    stat2.conversation_id = "conv-2"
-    stat2.message_count = 2
-    stat2.classifications = "registration"
-    mock_stats.append(stat2)
-    
-    mock_db.data["conversation_stats"] = mock_stats
-    
-    result = await get_conversation_stats(mock_db)
-    
-    assert result["total_conversations"] == 2
-    assert len(result["conversations"]) == 2
+# =============================================================================
+# Scale smoke tests
+# =============================================================================
 
+_SCALE_ROWS = 10_000
 
-@pytest.mark.asyncio
-async def test_get_conversation_stats_handles_null_classifications(mock_db):
-    """Test get_conversation_stats handles null classifications gracefully."""
-    mock_stat = MagicMock()
-    mock_stat.conversation_id = "conv-null"
-    mock_stat.message_count = 1
-    mock_stat.classifications = None
-    
-    mock_db.data["conversation_stats"] = [mock_stat]
-    
-    result = await get_conversation_stats(mock_db)
-    
-    assert result["total_conversations"] == 1
-    assert result["conversations"][0]["classifications"] == []
+
+@pytest.fixture
+def big_rows():
+    """A large conversation thread, built only for the tests that ask for it."""
+    return [
+        EmailRow(id=i, message_id=f"msg-{i}", conversation_id="conv-abc", subject=f"Message {i}")
+        for i in range(_SCALE_ROWS)
+    ]
+
+
+@pytest.mark.asyncio(loop_scope="module")
+@pytest.mark.parametrize("key, query, args", [
+    ("conversation_emails", get_emails_by_conversation, ("conv-abc",)),
+    ("recent_emails", get_recent_emails, (_SCALE_ROWS,)),
+], ids=["by-conversation", "recent"])
+async def test_row_queries_scale(mock_db, big_rows, key, query, args):
+    """Test the row-returning queries map a large result set one dict per row, in order."""
+    mock_db.data[key] = big_rows
+    
+    result = await query(mock_db, *args)
+    
+    assert len(result) == _SCALE_ROWS
+    assert result[0]["message_id"] == "msg-0"
+    assert result[-1]["message_id"] == f"msg-{_SCALE_ROWS - 1}"
@@ -0,0 +1,55 @@
+"""Tests for regex-based PII masking."""
+import sys
+import os
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from fast_mask import fast_mask
+
+REGENT_DOMAINS = ("@regent.ac.za", "@myregent.ac.za")
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("Contact me at jane.doe@gmail.com please", "Contact me at <EMAIL_ADDRESS> please"),
+    ("Call 082 123 4567 today", "Call <PHONE_NUMBER> today"),
+    ("Call +27 82 123 4567 today", "Call <PHONE_NUMBER> today"),
+    ("My ID is 9001015009087", "My ID is <ZA_ID_NUMBER>"),
+    ("Card 4111 1111 1111 1111 was charged", "Card <CREDIT_CARD> was charged"),
+    ("Paid from GB82 WEST 1234 5698 7654 32", "Paid from <IBAN_CODE>"),
+    ("Logged in from 196.25.1.10", "Logged in from <IP_ADDRESS>"),
+])
+def test_fast_mask_masks_structured_pii(text, expected):
+    """Each supported identifier is replaced with its entity placeholder."""
+    masked, count = fast_mask(text)
+    assert masked == expected
+    assert count == 1
+
+
+def test_fast_mask_preserves_kept_domains():
+    """Addresses on kept domains are not masked."""
+    text = "Reply to support@regent.ac.za or me@gmail.com"
+    masked, count = fast_mask(text, REGENT_DOMAINS)
+    assert masked == "Reply to support@regent.ac.za or <EMAIL_ADDRESS>"
+    assert count == 1
+
+
+def test_fast_mask_masks_lookalike_domains():
+    """A kept domain only counts at the end of the address."""
+    masked, count = fast_mask("Write to x@regent.ac.za.example.com", REGENT_DOMAINS)
+    assert masked == "Write to <EMAIL_ADDRESS>"
+    assert count == 1
+
+
+def test_fast_mask_skips_invalid_checksums():
+    """Digit runs that fail the Luhn check are left alone."""
+    text = "Reference 1234 5678 9012 3456"
+    assert fast_mask(text) == (text, 0)
+
+
+def test_fast_mask_leaves_plain_text():
+    """Text without identifiers is returned unchanged."""
+    text = "When will my results for module FIN101 be released in 2025?"
+    assert fast_mask(text) == (text, 0)
+    assert fast_mask("") == ("", 0)
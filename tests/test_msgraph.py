@@ -0,0 +1,130 @@
+"""Tests for MS Graph helpers (js/pyodide mocked - only available in CF Workers)."""
+import asyncio
+import sys
+import os
+from datetime import datetime, timedelta, timezone
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+sys.modules.setdefault('js', MagicMock())
+sys.modules.setdefault('pyodide', MagicMock())
+sys.modules.setdefault('pyodide.ffi', sys.modules['pyodide'].ffi)
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import msgraph
+
+
+@pytest.fixture(autouse=True)
+def clear_token_cache():
+    msgraph._TOKEN_CACHE.clear()
+    msgraph._TOKEN_LOCKS.clear()
+    yield
+    msgraph._TOKEN_CACHE.clear()
+    msgraph._TOKEN_LOCKS.clear()
+
+
+async def test_get_access_token_reuses_cached_token():
+    """A valid cached token is returned without another token request."""
+    fetch_token = AsyncMock(return_value=("token-1", 3600))
+    with patch.object(msgraph, "_fetch_access_token", fetch_token):
+        first = await msgraph.get_access_token("tenant", "client", "secret")
+        second = await msgraph.get_access_token("tenant", "client", "secret")
+
+    assert first == second == "token-1"
+    assert fetch_token.await_count == 1
+
+
+async def test_get_access_token_refreshes_near_expiry():
+    """A token inside the expiry margin is replaced."""
+    fetch_token = AsyncMock(side_effect=[("old", 30), ("new", 3600)])
+    with patch.object(msgraph, "_fetch_access_token", fetch_token):
+        assert await msgraph.get_access_token("tenant", "client", "secret") == "old"
+        assert await msgraph.get_access_token("tenant", "client", "secret") == "new"
+
+    assert fetch_token.await_count == 2
+
+
+async def test_get_access_token_concurrent_callers_share_refresh():
+    """Concurrent cold-start callers trigger a single token request."""
+    async def slow_fetch(*args):
+        await asyncio.sleep(0)
+        return "token", 3600
+
+    fetch_token = AsyncMock(side_effect=slow_fetch)
+    with patch.object(msgraph, "_fetch_access_token", fetch_token):
+        tokens = await asyncio.gather(
+            *[msgraph.get_access_token("tenant", "client", "secret") for _ in range(5)])
+
+    assert tokens == ["token"] * 5
+    assert fetch_token.await_count == 1
+
+
+@pytest.mark.parametrize("keys, expected", [
+    (("from", "emailAddress", "address"), "student@example.com"),
+    (("from", "emailAddress", "missing"), "default"),
+    (("body", "content"), "default"),
+    (("subject", "nested"), "default"),
+])
+def test_safe_get(keys, expected):
+    """Nested lookups return the value, or the default for missing/null/non-dict steps."""
+    data = {
+        "subject": "Hello",
+        "body": None,
+        "from": {"emailAddress": {"address": "student@example.com"}},
+    }
+    assert msgraph.safe_get(data, *keys, default="default") == expected
+
+
+def test_expiration_str_is_utc_rfc3339():
+    """Subscription expirations are second-precision UTC with a Z suffix."""
+    value = msgraph._expiration_str(msgraph.SUBSCRIPTION_EXPIRATION_MINUTES)
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+    assert value.endswith("Z") and "." not in value
+    expected = datetime.now(timezone.utc) + timedelta(minutes=4230)
+    assert abs((parsed - expected).total_seconds()) < 5
+
+
+def test_graph_headers_memoized_per_token():
+    """Header objects are reused for a token and replaced when it changes."""
+    msgraph._GRAPH_HEADERS.clear()
+    first = msgraph._graph_headers("token-a")
+
+    assert msgraph._graph_headers("token-a") is first
+    msgraph._graph_headers("token-a", text_body=True)
+    assert set(msgraph._GRAPH_HEADERS) == {("token-a", False), ("token-a", True)}
+    msgraph._graph_headers("token-b")
+    assert list(msgraph._GRAPH_HEADERS) == [("token-b", False)]
+
+
+def test_token_request_encodes_secret():
+    """Secrets with form-reserved characters are escaped in the token body."""
+    url, body = msgraph._token_request("tenant", "client", "a+b=c&d")
+
+    assert url == "https://login.microsoftonline.com/tenant/oauth2/v2.0/token"
+    assert "client_secret=a%2Bb%3Dc%26d" in body
+    assert "grant_type=client_credentials" in body
+
+
+def _graph_page(payload):
+    response = MagicMock(ok=True)
+    response.json = AsyncMock(return_value=MagicMock(to_py=lambda: payload))
+    return response
+
+
+async def test_list_subscriptions_follows_next_link():
+    """Every page of subscriptions is collected."""
+    fetch = AsyncMock(side_effect=[
+        _graph_page({
+            "value": [{"id": "a", "resource": "r1", "expirationDateTime": "e1"}],
+            "@odata.nextLink": "https://graph.microsoft.com/v1.0/subscriptions?$skiptoken=x",
+        }),
+        _graph_page({"value": [{"id": "b", "resource": "r2", "expirationDateTime": "e2"}]}),
+    ])
+    with patch.object(msgraph, "fetch", fetch):
+        subscriptions = await msgraph.list_subscriptions("token")
+
+    assert [sub["id"] for sub in subscriptions] == ["a", "b"]
+    assert fetch.await_args_list[1].args[0].endswith("$skiptoken=x")
@@ -0,0 +1,210 @@
+"""Tests for Presidio email masking (js/pyodide mocked - only available in CF Workers)."""
+import asyncio
+import json
+import sys
+import os
+import time
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+sys.modules.setdefault('js', MagicMock())
+sys.modules.setdefault('pyodide', MagicMock())
+sys.modules.setdefault('pyodide.ffi', sys.modules['pyodide'].ffi)
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import presidio
+
+
+def _masked(text, found=0, masked=0):
+    return {
+        "masked_text": text,
+        "original_text": text,
+        "entities_found": found,
+        "entities_masked": masked,
+        "success": True,
+    }
+
+
+async def test_mask_email_content_masks_all_fields_in_one_call():
+    """Subject, body, name and address go to Presidio as one combined text."""
+    async def fake_mask(text):
+        return _masked(text.replace("Thandi", "<PERSON>"), found=2, masked=2)
+
+    mask_pii = AsyncMock(side_effect=fake_mask)
+    with patch.object(presidio, "mask_pii", mask_pii):
+        result = await presidio.mask_email_content(
+            "Hello from Thandi", "<p>Thandi here</p>", "Thandi Mokoena", "t@example.com")
+
+    assert mask_pii.await_count == 1
+    assert result["subject"] == "Hello from <PERSON>"
+    assert result["body"] == "<PERSON> here"
+    assert result["from_name"] == "<PERSON> Mokoena"
+    assert result["from_address"] == "<EMAIL_ADDRESS>"
+    assert result["total_entities_masked"] == 3  # fast-masked address + 2 from Presidio
+    assert result["success"] is True
+
+
+async def test_mask_email_content_falls_back_when_fields_merge():
+    """If the combined result loses a separator, each field is masked on its own."""
+    async def fake_mask(text):
+        if presidio._FIELD_SEP in text:
+            return _masked(text.replace(presidio._FIELD_SEP, " ", 1))
+        return _masked(text)
+
+    mask_pii = AsyncMock(side_effect=fake_mask)
+    with patch.object(presidio, "mask_pii", mask_pii):
+        result = await presidio.mask_email_content("Subject", "Body", "Name", "")
+
+    assert mask_pii.await_count == 5
+    assert (result["subject"], result["body"], result["from_name"]) == ("Subject", "Body", "Name")
+
+
+async def test_mask_email_content_fallback_masks_identical_fields_once():
+    """In the per-field fallback, repeated field texts share one mask_pii call."""
+    async def fake_mask(text):
+        if presidio._FIELD_SEP in text:
+            return _masked(text.replace(presidio._FIELD_SEP, " ", 1))
+        names = text.count("Thandi")
+        return _masked(text.replace("Thandi", "<PERSON>"), found=names, masked=names)
+
+    mask_pii = AsyncMock(side_effect=fake_mask)
+    with patch.object(presidio, "mask_pii", mask_pii):
+        result = await presidio.mask_email_content("Thandi", "Body", "Thandi", "")
+
+    assert mask_pii.await_count == 1 + 3  # combined, then "Thandi", "Body" and ""
+    assert (result["subject"], result["from_name"]) == ("<PERSON>", "<PERSON>")
+    assert result["total_entities_masked"] == 2  # still counted per field
+
+
+async def test_mask_email_content_handles_null_fields():
+    """A null subject or name from Graph does not skip Presidio for the rest of the email."""
+    async def fake_mask(text):
+        return _masked(text.replace("John Smith", "<PERSON>"), found=1, masked=1)
+
+    mask_pii = AsyncMock(side_effect=fake_mask)
+    with patch.object(presidio, "mask_pii", mask_pii):
+        result = await presidio.mask_email_content(None, "Hi, I am John Smith", None, "")
+
+    assert mask_pii.await_count == 1
+    assert result["subject"] == ""
+    assert result["body"] == "Hi, I am <PERSON>"
+    assert result["success"] is True
+
+
+async def test_analyzer_breaker_opens_after_repeated_failures():
+    """Once the analyzer keeps failing, calls return [] without fetching until the cooldown passes."""
+    fetch = AsyncMock(side_effect=RuntimeError("connection refused"))
+    with patch.object(presidio, "fetch", fetch), \
+            patch.dict(presidio._BREAKERS["analyzer"], {"fails": 0, "opened_at": 0.0}):
+        for _ in range(presidio.BREAKER_THRESHOLD + 3):
+            assert await presidio.analyze_text("Call Thandi") == []
+        assert fetch.await_count == presidio.BREAKER_THRESHOLD
+
+        presidio._BREAKERS["analyzer"]["opened_at"] -= presidio.BREAKER_COOLDOWN
+        await presidio.analyze_text("Call Thandi")
+        assert fetch.await_count == presidio.BREAKER_THRESHOLD + 1
+
+
+async def test_analyzer_breaker_lets_one_probe_through_when_half_open():
+    """After the cooldown, concurrent calls send a single probe until it reports back."""
+    release = asyncio.Event()
+
+    async def slow_failure(*args):
+        await release.wait()
+        raise RuntimeError("still down")
+
+    fetch = AsyncMock(side_effect=slow_failure)
+    opened_at = time.monotonic() - presidio.BREAKER_COOLDOWN
+    with patch.object(presidio, "fetch", fetch), \
+            patch.dict(presidio._BREAKERS["analyzer"],
+                       {"fails": presidio.BREAKER_THRESHOLD, "opened_at": opened_at, "probe_at": 0.0}):
+        probe = asyncio.create_task(presidio.analyze_text("Call Thandi"))
+        await asyncio.sleep(0)
+        assert await asyncio.gather(*[presidio.analyze_text("Call Thandi") for _ in range(3)]) == [[]] * 3
+        assert fetch.await_count == 1
+
+        release.set()
+        assert await probe == []
+        # The failed probe re-opens the breaker for a full cooldown
+        assert await presidio.analyze_text("Call Thandi") == []
+        assert fetch.await_count == 1
+
+
+async def test_mask_pii_skips_analyzer_without_candidates():
+    """Lower-case text with no digits or @ never reaches the analyzer."""
+    analyze = AsyncMock(return_value=[])
+    with patch.object(presidio, "analyze_text", analyze):
+        result = await presidio.mask_pii("thanks, that worked!")
+        await presidio.mask_pii("Thanks, that worked!")
+
+    assert result["success"] is True
+    assert result["masked_text"] == "thanks, that worked!"
+    assert analyze.await_count == 1
+
+
+async def test_mask_email_content_fast_masks_address_in_from_name():
+    """An address used as the display name is masked locally like the other fields."""
+    with patch.object(presidio, "mask_pii", AsyncMock(side_effect=lambda text: _masked(text))):
+        result = await presidio.mask_email_content("Hi", "Body", "jane@gmail.com", "jane@gmail.com")
+
+    assert result["from_name"] == "<EMAIL_ADDRESS>"
+    assert result["from_address"] == "<EMAIL_ADDRESS>"
+
+
+async def test_analyze_text_only_requests_plausible_entities():
+    """Entity types whose local gate finds nothing are left out of the request."""
+    response = MagicMock(ok=True)
+    response.json = AsyncMock(return_value=MagicMock(to_py=lambda: []))
+    fetch = AsyncMock(return_value=response)
+    sent = []
+    with patch.object(presidio, "fetch", fetch), \
+            patch.object(presidio, "to_js", side_effect=lambda options: sent.append(options) or options), \
+            patch.dict(presidio._BREAKERS["analyzer"], {"fails": 0, "opened_at": 0.0}):
+        await presidio.analyze_text("Hi Thandi, see you soon")
+        await presidio.analyze_text("Thandi 9001015009087")
+
+    first, second = (json.loads(options["body"]) for options in sent)
+    assert first["entities"] == ["PERSON"]
+    assert "ad_hoc_recognizers" not in first
+    assert second["entities"] == ["PHONE_NUMBER", "PERSON", "ZA_ID_NUMBER"]
+    assert second["ad_hoc_recognizers"][0]["supported_entity"] == "ZA_ID_NUMBER"
+
+
+async def test_mask_pii_masks_email_addresses_except_regent():
+    """Called directly, mask_pii still masks email addresses and keeps Regent ones."""
+    text = "Mail jane@gmail.com or help@regent.ac.za"
+    analyzer_response = MagicMock(ok=True)
+    analyzer_response.json = AsyncMock(return_value=MagicMock(to_py=lambda: [
+        {"entity_type": "EMAIL_ADDRESS", "start": 5, "end": 19, "score": 1.0},
+        {"entity_type": "EMAIL_ADDRESS", "start": 23, "end": 40, "score": 1.0},
+    ]))
+    anonymizer_response = MagicMock(ok=True)
+    anonymizer_response.json = AsyncMock(return_value=MagicMock(
+        to_py=lambda: {"text": "Mail <EMAIL_ADDRESS> or help@regent.ac.za"}))
+    fetch = AsyncMock(side_effect=[analyzer_response, anonymizer_response])
+    sent = []
+    with patch.object(presidio, "fetch", fetch), \
+            patch.object(presidio, "to_js", side_effect=lambda options: sent.append(options) or options), \
+            patch.dict(presidio._BREAKERS["analyzer"], {"fails": 0, "opened_at": 0.0}), \
+            patch.dict(presidio._BREAKERS["anonymizer"], {"fails": 0, "opened_at": 0.0}):
+        result = await presidio.mask_pii(text)
+
+    assert "EMAIL_ADDRESS" in json.loads(sent[0]["body"])["entities"]
+    assert json.loads(sent[1]["body"])["analyzer_results"] == [
+        {"entity_type": "EMAIL_ADDRESS", "start": 5, "end": 19, "score": 1.0}]
+    assert result["masked_text"] == "Mail <EMAIL_ADDRESS> or help@regent.ac.za"
+    assert (result["entities_found"], result["entities_masked"]) == (2, 1)
+
+
+def test_filter_regent_emails_keeps_regent_addresses_only():
+    """Regent addresses are dropped from the results, matched case-insensitively."""
+    text = "Ask Support@Regent.ac.za or jane@gmail.com"
+    results = [
+        {"entity_type": "EMAIL_ADDRESS", "start": 4, "end": 24},
+        {"entity_type": "EMAIL_ADDRESS", "start": 28, "end": 42},
+        {"entity_type": "PERSON", "start": 28, "end": 32},
+    ]
+
+    assert presidio.filter_regent_emails(text, results) == results[1:]
@@ -0,0 +1,52 @@
+"""Tests for shared utility functions."""
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from utils import strip_html
+
+
+def test_strip_html_empty():
+    """Empty or None input returns an empty string."""
+    assert strip_html("") == ""
+    assert strip_html(None) == ""
+
+
+def test_strip_html_removes_tags():
+    """Tags are removed and whitespace collapsed."""
+    html = "<div><p>Hello</p>\n<p>World</p></div>"
+    assert strip_html(html) == "Hello World"
+
+
+def test_strip_html_drops_script_and_style_blocks():
+    """Script and style contents are not treated as text."""
+    html = "<style>p { color: red; }</style><p>Hi</p><SCRIPT>alert(1)</SCRIPT>"
+    assert strip_html(html) == "Hi"
+
+
+def test_strip_html_decodes_common_entities():
+    """Common entities are decoded to their characters."""
+    html = "Fees &amp; payments&nbsp;&lt;2025&gt; &quot;urgent&quot;"
+    assert strip_html(html) == 'Fees & payments <2025> "urgent"'
+
+
+def test_strip_html_removes_zero_width_chars():
+    """Invisible unicode characters are removed."""
+    assert strip_html("Hel​lo﻿") == "Hello"
+
+
+def test_strip_html_decodes_all_entities():
+    """Numeric and less common named entities become their characters."""
+    assert strip_html("caf&#233; &#8211; fees&#160;due &rsquo;ok&hellip;") == "café – fees due ’ok…"
+
+
+def test_strip_html_plain_text_only_normalizes_whitespace():
+    """Text without markup or entities is only whitespace-normalized."""
+    assert strip_html("  Dear team,\r\n\r\nMy results are missing.\n") == "Dear team, My results are missing."
+
+
+def test_strip_html_keeps_text_after_unclosed_script_or_style():
+    """An unclosed <script> or <style> only drops the tag, not the rest of the text."""
+    assert strip_html("I typed <script> in the form") == "I typed in the form"
+    assert strip_html("Query re <style> issue, please help") == "Query re issue, please help"